@@ -34,11 +34,16 @@ setup(
         author_email = 'leon.kuchenbecker@uni-tuebingen.de',
         description = 'Assignment Tool',
         install_requires = requires,
+        extras_require = {
+            'cohort' : [ 'pypdf' ],
+            'cache'  : [ 'pyarrow' ],
+            },
         zip_safe = False,
         include_package_data=True,
         entry_points={
             'console_scripts' : [
                 'assignment-tool          = assignmenttool:main',
+                'assignment-tool-bench    = assignmenttool.benchmark:main',
                 ],
             },
         )
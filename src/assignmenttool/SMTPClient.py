@@ -26,31 +26,84 @@ from email.mime.text import MIMEText
 from email.utils import parseaddr, formataddr
 import smtplib
 import ssl
+import queue
+import threading
+import time
+
+from concurrent.futures import ThreadPoolExecutor
+
+from assignmenttool.errors import AToolError
+from assignmenttool.stats import collector
+
+def is_fatal(error):
+    """Checks whether `error` prevents sending any message, e.g. a failed
+    login or a refused connection, rather than affecting a single message"""
+    if isinstance(error, (smtplib.SMTPRecipientsRefused, smtplib.SMTPDataError)):
+        return False
+    # SMTPException is a subclass of OSError
+    return isinstance(error, OSError)
 
 class SMTPClient:
+    """SMTP client that keeps a single authenticated session open across
+    multiple messages. The connection is re-established transparently if the
+    server closes it or after `max_messages` messages have been sent over
+    it."""
 
     def __init__(self,
             hostname = 'localhost',
             port = '587',
             user = None,
             password = None,
-            tls = False):
-        self.hostname = hostname
-        self.port     = port
-        self.user     = user
-        self.password = password
-        self.tls      = tls
+            tls = False,
+            max_messages = None):
+        self.hostname     = hostname
+        self.port         = port
+        self.user         = user
+        self.password     = password
+        self.tls          = tls
+        self.max_messages = max_messages
+        self.server       = None
+        self.sent         = 0
 
-    def sendMessage(self,
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def connect(self):
+        """Opens and authenticates a new SMTP session"""
+        self.close()
+        collector.count('smtp_connections')
+        server = smtplib.SMTP(self.hostname, self.port)
+        try:
+            if self.tls:
+                server.starttls()
+            if self.user:
+                server.login(self.user, self.password)
+        except:
+            server.close()
+            raise
+        self.server = server
+        self.sent   = 0
+
+    def close(self):
+        """Closes the current SMTP session, if any"""
+        if self.server is None:
+            return
+        try:
+            self.server.quit()
+        except smtplib.SMTPException:
+            self.server.close()
+        self.server = None
+
+    def buildMessage(self,
             sender,
             recipients,
             subject,
             message_text,
-            attachments = {},
-            bcc = None):
-
-        if not isinstance(recipients, list):
-            recipients = [ recipients ]
+            attachments = {}):
+        """Builds the MIME message and returns it as a string"""
 
         message = MIMEMultipart()
 
@@ -59,28 +112,159 @@ class SMTPClient:
         message["To"] = ', '.join([formataddr(recipient) for recipient in recipients])
         message["Subject"] = subject
 
-        # Add BCC recipients after building the 'To' header
-        if bcc:
-            if isinstance(bcc, list):
-                recipients += [ (None, elem) for elem in bcc ]
-            else:
-                recipients.append((None, bcc))
-
         message.attach(MIMEText(message_text, 'plain'))
         for fname, data in attachments.items():
             app_type = 'pdf' if fname[-4:].lower() == '.pdf' else 'octet-stream'
             part = MIMEBase("application", app_type)
             part.set_payload(data)
             email.encoders.encode_base64(part)
-            bfname = fname.encode('utf-8')
             part.add_header('Content-Disposition', 'attachment', filename=fname)
             message.attach(part)
 
-        text = message.as_string()
+        return message.as_string()
 
-        with smtplib.SMTP(self.hostname, self.port) as server:
-            if self.tls:
-                server.starttls()
-            if self.user:
-                server.login(self.user, self.password)
-            server.sendmail(sender[1], [ r[1] for r in recipients], text)
+    def sendMessage(self,
+            sender,
+            recipients,
+            subject,
+            message_text,
+            attachments = {},
+            bcc = None):
+
+        if not isinstance(recipients, list):
+            recipients = [ recipients ]
+
+        text = self.buildMessage(sender, recipients, subject, message_text, attachments)
+
+        # Add BCC recipients after building the 'To' header
+        recipients = list(recipients)
+        if bcc:
+            if isinstance(bcc, list):
+                recipients += [ (None, elem) for elem in bcc ]
+            else:
+                recipients.append((None, bcc))
+
+        start = time.perf_counter()
+        if self.server is None or (self.max_messages and self.sent >= self.max_messages):
+            self.connect()
+        try:
+            self.server.sendmail(sender[1], [ r[1] for r in recipients], text)
+        except smtplib.SMTPServerDisconnected:
+            # The server closed the session, e.g. due to an idle timeout
+            self.connect()
+            self.server.sendmail(sender[1], [ r[1] for r in recipients], text)
+        self.sent += 1
+        collector.count('messages_sent')
+        collector.count('bytes_sent', len(text))
+        collector.latency('send', time.perf_counter() - start)
+
+class TokenBucket:
+    """Thread safe token bucket limiting the rate of operations to `rate`
+    per second"""
+
+    def __init__(self, rate, burst = 1):
+        self.rate   = rate
+        self.burst  = burst
+        self.tokens = burst
+        self.last   = time.monotonic()
+        self.lock   = threading.Lock()
+
+    def acquire(self):
+        """Blocks until a token is available and consumes it"""
+        with self.lock:
+            while True:
+                now         = time.monotonic()
+                self.tokens = min(self.burst, self.tokens + (now - self.last) * self.rate)
+                self.last   = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                time.sleep((1 - self.tokens) / self.rate)
+
+class SMTPPool:
+    """Sends messages concurrently over a bounded number of SMTP sessions,
+    optionally limited to `rate` messages per second. If `backlog` is set,
+    at most that many messages are queued at any time. The remaining keyword
+    arguments are passed on to every SMTPClient.
+
+    Errors that affect all messages, such as a failed login, stop the pool:
+    queued messages are cancelled and no further messages are accepted."""
+
+    def __init__(self, size = 1, rate = None, backlog = None, **kwargs):
+        self.clients = queue.Queue()
+        self.all     = [ SMTPClient(**kwargs) for _ in range(size) ]
+        for client in self.all:
+            self.clients.put(client)
+        self.bucket   = TokenBucket(rate) if rate else None
+        self.backlog  = threading.BoundedSemaphore(backlog) if backlog else None
+        self.executor = ThreadPoolExecutor(max_workers = size)
+        self.pending  = set()
+        self.lock     = threading.Lock()
+        self.error    = None
+        self.address  = f"{kwargs.get('hostname')}:{kwargs.get('port')}"
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def _send(self, kwargs):
+        if self.bucket:
+            self.bucket.acquire()
+        client = self.clients.get()
+        try:
+            self.check()
+            client.sendMessage(**kwargs)
+        except Exception as e:
+            if is_fatal(e):
+                with self.lock:
+                    if self.error is None:
+                        self.error = e
+                self.cancel()
+            raise
+        finally:
+            self.clients.put(client)
+
+    def _done(self, future):
+        with self.lock:
+            self.pending.discard(future)
+        if self.backlog:
+            self.backlog.release()
+
+    def submit(self, **kwargs):
+        """Queues a message for sending, taking the same arguments as
+        SMTPClient.sendMessage(). Blocks while the backlog is full. Returns a
+        future for the result."""
+        self.check()
+        if self.backlog:
+            self.backlog.acquire()
+        try:
+            future = self.executor.submit(self._send, kwargs)
+        except:
+            if self.backlog:
+                self.backlog.release()
+            raise
+        with self.lock:
+            self.pending.add(future)
+        future.add_done_callback(self._done)
+        return future
+
+    def check(self):
+        """Raises an AToolError if the pool was stopped by an error that
+        affects all messages"""
+        if self.error is not None:
+            raise AToolError(f'Cannot send mail via {self.address}: {self.error}')
+
+    def cancel(self):
+        """Cancels all queued messages that are not being sent yet"""
+        with self.lock:
+            pending = list(self.pending)
+        for future in pending:
+            future.cancel()
+
+    def close(self):
+        """Waits for all queued messages and closes all sessions"""
+        self.executor.shutdown(wait = True)
+        for client in self.all:
+            client.close()
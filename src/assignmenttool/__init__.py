@@ -19,164 +19,73 @@
 # SOFTWARE.
 
 import argparse
-import pandas as pd
+import contextlib
+import cProfile
+import importlib
 import sys
-import tempfile
-import subprocess
 import os
 import shutil
-import getpass
-
-from collections import defaultdict
-from assignmenttool.errors import AToolError
-
-from assignmenttool import config, SMTPClient
-
-####################################################################################################
-
-def compileLaTeX(tex, pdflatex, keepdir = False):
-    """ Compile the 'hmm.tex' file in the given directory """
-    tdir = tempfile.mkdtemp()
-    out = open(tdir + '/out.tex', 'w')
-    out.write(tex)
-    out.close()
-    ret = subprocess.run([pdflatex, '--interaction', 'batchmode', 'out'], cwd = tdir, stdout = subprocess.PIPE, stderr = subprocess.PIPE)
-    if ret.returncode != 0:
-        raise AToolError(f"An error occurred during LaTeX execution in '{tdir}'")
-    ret = subprocess.run([pdflatex, '--interaction', 'batchmode', 'out'], cwd = tdir, stdout = subprocess.PIPE, stderr = subprocess.PIPE)
-    if ret.returncode != 0:
-        raise AToolError(f"An error occurred during LaTeX execution in '{tdir}'")
-    with open(os.path.join(tdir, 'out.pdf'), 'rb') as infile:
-        pdf = infile.read()
-    if keepdir:
-        return tdir, pdf
-    shutil.rmtree(tdir)
-    return None, pdf
-
-####################################################################################################
-
-def mail_feedback(config, participants, pdfs):
-    """Send the feedback PDFs to the participants"""
-    if config.mail_smtp_user and not config.mail_smtp_pass:
-        config.smtp_password = getpass.getpass(f'Password for [{config.mail_smtp_user}@{config.mail_smtp_host}]: ')
-
-    smtp = SMTPClient.SMTPClient(
-            hostname = config.mail_smtp_host,
-            port = config.mail_smtp_port,
-            user = config.mail_smtp_user,
-            password = config.smtp_password,
-            tls = not config.mail_smtp_no_tls)
+import tempfile
 
-    for user, pdf in pdfs.items():
-        # Lookup recipient name and email address
-        try:
-            name = participants.loc[user]['Name']
-            email = participants.loc[user]['E-Mail']
-        except KeyError:
-            raise AToolError(f'Failed to look up name and email address for user "{user}".')
-        smtp.sendMessage(
-                sender       = (config.mail_sender_name, config.mail_sender_address),
-                recipients   = (name, email),
-                subject      = config.mail_subject.replace('§§username§§', user).replace('§§name§§', name).replace('§§sheetnr§§', str(config.sheet)).replace('§§tutorname§§', config.tutor_name),
-                message_text = config.mail_template_text.replace('§§username§§', user).replace('§§name§§', name).replace('§§sheetnr§§', str(config.sheet)),
-                attachments  = {
-                    pdf['filename'] : pdf['data']
-                    },
-                bcc = config.mail_bcc
-                )
-        print(f'[OK]\t{user} -> {name} <{email}>')
+from collections import deque, namedtuple
+from concurrent.futures import ThreadPoolExecutor
+from assignmenttool.archive import Archive
+from assignmenttool.errors import AToolError, CompileError
+
+from assignmenttool import config
+from assignmenttool.pdfcache import PDFCache
+from assignmenttool.template import Template, escape_latex
+from assignmenttool.journal import Journal, digest
+from assignmenttool.stats import collector
+from assignmenttool.latex import compileLaTeX, compile_cohort, build_format, CompileGroup, CompileStats
+
+# pandas, email and smtplib take a noticeable time to import. Modules
+# depending on them are only imported once they are needed, but their
+# functions remain available as attributes of this package.
+_LAZY_ATTRIBUTES = {
+        'grading'        : ('assignmenttool.grading', None),
+        'load_workbook'  : ('assignmenttool.workbook', 'load_workbook'),
+        'FeedbackMailer' : ('assignmenttool.mailer', 'FeedbackMailer'),
+        'mail_feedback'  : ('assignmenttool.mailer', 'mail_feedback'),
+        }
+
+def __getattr__(name):
+    try:
+        module, attribute = _LAZY_ATTRIBUTES[name]
+    except KeyError:
+        raise AttributeError(f"module '{__name__}' has no attribute '{name}'")
+    module = importlib.import_module(module)
+    return getattr(module, attribute) if attribute else module
 
 ####################################################################################################
 
 def read_scores(infile):
     """Reads the scores from the Excel sheet while being as relaxed about the
     data type of the task / subtask columns as possible"""
-    scores = pd.read_excel(infile, sheet_name = 'Grading', dtype={
-        'Username' : str,
-        'Sheet'    : 'Int64',
-        'Task'     : 'Int64',
-        'Subtask'  : 'Int64',
-        'Type'     : str,
-        'Value'    : object,
-        })
-
-    return scores
+    from assignmenttool.workbook import load_workbook
+    return load_workbook(infile).grading
 
-def process(config):
-    # Read Scores and comments
-    scores = read_scores(config.infile)
+Document = namedtuple('Document', [ 'sheet', 'user', 'outpath', 'tex', 'total', 'maxtotal' ])
 
-    # Read participants
-    participants = pd.read_excel(config.infile, sheet_name = 'Participants').set_index('Username')
+# Variables available in the LaTeX template and the PDF file name
+TEX_VARIABLES      = [ 'sheetnr', 'fullname', 'tutorname', 'total', 'maxtotal', 'global', 'body', 'tasks' ]
+FILENAME_VARIABLES = [ 'username', 'name', 'sheetnr' ]
 
-    # Read maximum scores
-    sheet_meta       = pd.read_excel(config.infile, sheet_name = 'Sheets')
-    max_scores       = { (row.Sheet, row.Task, row.Subtask) : row.MaxScore for _, row in sheet_meta.iterrows() }
-    max_scores_sheet = sheet_meta.groupby('Sheet')['MaxScore'].sum()
-
-    # Select sheet
-    scores = scores[scores.Sheet==config.sheet]
-
-    if scores.empty:
-        print("No matching grades found")
-        return 1
-
-    # Read LaTeX template
-    try:
-        with open(config.tex_template, 'r') as infile:
-            template = infile.read()
-    except Exception as e:
-        raise AToolError(f"Cannot open template file '{config.tex_template}': {e}")
-
-    # Build dictionaries
-    d = defaultdict(lambda : defaultdict( lambda : { 'score' : None, 'comments' : []} ) )
-    sheet_comments = defaultdict(lambda : [])
-
-
-    for _,row in scores.iterrows():
-        if pd.isna(row.Sheet):
-            raise AToolError('Failed to parse provided Excel file, "Grading" sheet contains empty value for "Sheet" column.')
-        if row.Type.upper() == 'SCORE':
-            # Check if the row checks out
-            if pd.isna(row.Task) or pd.isna(row.Subtask) or pd.isna(row.Value):
-                raise AToolError(f'Failed to parse provided Excel file, "Grading" sheet contains empty value for "Task", "Subtask" or "Value" column for sheet {row.Sheet}.')
-            task = (row.Sheet, row.Task, row.Subtask)
-            record = d[row.Username][task]
-            # Check if a score occurs redundantly for the same task
-            if record['score'] is not None:
-                raise AToolError(f'Duplicate score for identical task found (User: {row.Username}, Sheet: {row.Sheet}, Task: {row.Task}, Subtask: {row.Subtask}')
-            # Obtain maximum attainable score
-            try:
-                record['max_score'] = max_scores[task]
-            except KeyError:
-                raise AToolError(f'Could not find maximum score for task {task}')
-            record['score'] = row.Value
-        elif row.Type.upper() == 'COMMENT':
-            if pd.isna(row.Value):
-                continue # Ignore empty comments
-            # Check if this is a comment that applies to the entire sheet
-            if pd.isna(row.Task) and pd.isna(row.Subtask):
-                sheet_comments[row.Username].append(row.Value)
-            elif pd.isna(row.Task) or pd.isna(row.Subtask):
-                raise AToolError(f'Failed to parse provided Excel file, "Grading" sheet contains empty value for "Task" or "Subtask" but not for both.')
-            # ... or if it's a comment that applies to a specific task
-            else:
-                task = (row.Sheet, row.Task, row.Subtask)
-                record = d[row.Username][task]
-                record['comments'].append(row.Value)
-        else:
-            raise AToolError(f'Invalid value type "{row.Type}".')
+def render_documents(config, tex_template, filename_template, sheet, grades, participants, max_scores_sheet):
+    """Renders the LaTeX documents for all users graded on `sheet` according
+    to the aggregated `grades`"""
+    escape = (lambda text : str(text)) if config.raw_comments else (lambda text : escape_latex(str(text)))
 
-    mail_todo = {}
-    for user, tasks in d.items():
+    documents = []
+    for user, tasks in grades.tasks.groupby('Username', sort = False):
         body=[]
 
         # Total score
-        total_score = sum([ record['score'] for _, record in tasks.items() if record['score'] ])
+        total_score = grades.totals[user]
         try:
-            max_total_score = max_scores_sheet.loc[config.sheet]
+            max_total_score = max_scores_sheet.loc[sheet]
         except KeyError:
-            raise AToolError(f'Cannot calculate maximum total score for sheet {config.sheet}')
+            raise AToolError(f'Cannot calculate maximum total score for sheet {sheet}')
 
         # Participant name
         try:
@@ -185,71 +94,358 @@ def process(config):
             raise AToolError(f'Cannot find real name for user "{user}".')
 
 
-        tex=template.replace('§§sheetnr§§', str(config.sheet)).replace('§§fullname§§', str(realname)).replace('§§tutorname§§', config.tutor_name).replace('§§total§§', str(total_score)).replace('§§maxtotal§§', str(max_total_score))
-
-        # Sort tasks and records
-        sorted_tasks = sorted([ (task, record) for task, record in tasks.items() ], key = lambda x : x[0])
+        # Tasks are already sorted
         cur_task = None
-        for task, record in sorted_tasks:
-            score_str = '{:.2f}'.format(record['score'])
-            if task[1] != cur_task:
-                cur_task = task[1]
+        for record in tasks.itertuples():
+            score_str = '{:.2f}'.format(record.Score)
+            if record.Task != cur_task:
+                cur_task = record.Task
                 body.append(r'\newtask{' + str(cur_task) + r'}')
-            body.append(f'\\scoreTask{{{task[0]}}}{{{task[1]}}}{{{task[2]}}}{{{score_str}}}{{{record["max_score"]}}}')
-            if record['comments']:
+            body.append(f'\\scoreTask{{{record.Sheet}}}{{{record.Task}}}{{{record.Subtask}}}{{{score_str}}}{{{record.MaxScore}}}')
+            comments = grades.comments.get((user, record.Sheet, record.Task, record.Subtask))
+            if comments:
                 body.append(r'\beforeComments')
-                for comment in record['comments']:
-                    body.append(f'\\comment{{{comment}}}')
+                for comment in comments:
+                    body.append(f'\\comment{{{escape(comment)}}}')
                 body.append(r'\afterComments')
 
         # Global comments
         global_ = []
-        if user in sheet_comments:
+        if user in grades.sheet_comments:
             global_.append('\\beforeGlobalComments')
-            global_comments = sheet_comments[user]
+            global_comments = grades.sheet_comments[user]
             for comment in global_comments:
-                global_.append(f'\\globalComment{{{comment}}}')
+                global_.append(f'\\globalComment{{{escape(comment)}}}')
             global_.append('\\afterGlobalComments')
 
-        # Write out and compile tex
-        tex = tex.replace('§§global§§', '\n'.join(global_))
-        tex = tex.replace('§§body§§', '\n'.join(body))
-        tex = tex.replace('§§tasks§§', '\n'.join(body))
-        tdir, pdf = compileLaTeX(tex, config.pdflatex, config.debug)
-
-        # Move output file in place
-        outpath = config.pdf_filename.replace('§§username§§', user).replace('§§name§§', realname).replace('§§sheetnr§§', str(config.sheet))
-
-        # Store locally unless in mail only mode
-        if not (config.no_local_file and config.mail):
-            if os.path.exists(outpath):
-                raise AToolError(f"Output path '{outpath}' exists! Aborting!")
-            with open(outpath, 'wb') as outfile:
-                outfile.write(pdf)
-            if config.debug:
-                print(f"[OK]\t{user} [temp dir '{tdir}']")
-            else:
-                print(f"[OK]\t{user}")
+        body = '\n'.join(body)
+        tex  = tex_template.render({
+                'sheetnr'   : sheet,
+                'fullname'  : escape_latex(str(realname)),
+                'tutorname' : escape_latex(config.tutor_name),
+                'total'     : total_score,
+                'maxtotal'  : max_total_score,
+                'global'    : '\n'.join(global_),
+                'body'      : body,
+                'tasks'     : body,
+                })
+
+        # Output file name
+        outpath = filename_template.render({ 'username' : user, 'name' : realname, 'sheetnr' : sheet })
+
+        documents.append(Document(sheet, user, outpath, tex, total_score, max_total_score))
+
+    return documents
+
+def read_templates(config):
+    """Reads the LaTeX template and returns its text together with the
+    LaTeX and PDF file name templates"""
+    try:
+        with open(config.tex_template, 'r') as infile:
+            template = infile.read()
+    except Exception as e:
+        raise AToolError(f"Cannot open template file '{config.tex_template}': {e}")
+    tex_template      = Template(template, TEX_VARIABLES, f"LaTeX template '{config.tex_template}'")
+    filename_template = Template(config.pdf_filename, FILENAME_VARIABLES, 'PDF file name')
+    return template, tex_template, filename_template
+
+def select_sheets(config, scores):
+    """Returns the sheets to process, all sheets with grades unless specified"""
+    if config.sheets is not None:
+        return config.sheets
+    return sorted(int(sheet) for sheet in scores.Sheet.dropna().unique())
+
+def preflight(config, journal, archive, scores, sheets, sheet_meta, participants, max_scores_sheet, filename_template):
+    """Checks the grades of all sheets as well as the participants and output
+    paths of all documents, which would otherwise abort the run halfway
+    through. With an archive, output paths are checked against its members. Reports all problems at once and raises an AToolError if there
+    are any. Returns the aggregated grades per sheet."""
+    import pandas as pd
+    from assignmenttool import grading
+
+    problems = []
+    grades   = {}
+    outpaths = {}
+    store    = not (config.no_local_file and config.mail)
+
+    for user in participants.index[participants.index.duplicated()].unique():
+        problems.append(f'Participant "{user}" is listed more than once.')
+    participants = participants[~participants.index.duplicated()]
+
+    for sheet in sheets:
+        sheet_scores = scores[scores.Sheet==sheet]
+        if sheet_scores.empty:
+            continue
+        try:
+            with collector.phase('aggregate'):
+                grades[sheet] = grading.aggregate(sheet_scores, sheet_meta)
+        except AToolError as e:
+            problems.append(f'Sheet {sheet}: {e}')
+            continue
+        if sheet not in max_scores_sheet.index:
+            problems.append(f'Cannot calculate maximum total score for sheet {sheet}')
+
+        for user in grades[sheet].totals:
+            try:
+                participant = participants.loc[user]
+            except KeyError:
+                problems.append(f'Cannot find real name for user "{user}" (sheet {sheet}).')
+                continue
+            if config.mail and not journal.done(sheet, user, 'mail') and pd.isna(participant.get('E-Mail')):
+                problems.append(f'No email address for user "{user}".')
+            outpath = filename_template.render({ 'username' : user, 'name' : participant.Name, 'sheetnr' : sheet })
+            if outpath not in outpaths and store and not journal.done(sheet, user, 'store'):
+                if archive is not None and outpath in archive:
+                    problems.append(f"Output path '{outpath}' exists in archive '{archive.path}'!")
+                elif archive is None and os.path.exists(outpath):
+                    problems.append(f"Output path '{outpath}' exists!")
+            outpaths.setdefault(outpath, []).append(f'{user} [sheet {sheet}]')
+
+    for outpath, users in outpaths.items():
+        if len(users) > 1:
+            problems.append(f"Output path '{outpath}' is used by {len(users)} documents: {', '.join(users)}")
+
+    if problems:
+        for problem in problems:
+            print(f'[FAILED]\t{problem}')
+        raise AToolError(f'Found {len(problems)} problem(s), no PDFs were compiled.')
+    return grades
+
+def process(config):
+    from assignmenttool.workbook import load_workbook
 
-        # Prepare email if requested to do so
-        if config.mail:
-            mail_todo[user] = {
-                    'filename' : os.path.basename(outpath),
-                    'data' : pdf
-                    }
+    collector.reset()
 
-    # Send out prepared emails
-    if mail_todo:
-        mail_feedback(config, participants, mail_todo)
+    # Read scores and comments, participants and maximum scores in one go
+    with collector.phase('read'):
+        workbook = load_workbook(config.infile, None if config.no_cache else os.path.join(config.cache_dir, 'workbook'))
+    scores   = workbook.grading
 
+    # Read participants
+    participants = workbook.participants.set_index('Username')
+
+    # Read maximum scores
+    sheet_meta       = workbook.sheets
+    max_scores_sheet = sheet_meta.groupby('Sheet')['MaxScore'].sum()
+
+    # Read LaTeX template
+    template, tex_template, filename_template = read_templates(config)
+
+    # Select sheets, all sheets with grades unless specified
+    sheets = select_sheets(config, scores)
+
+    # Only process the participants of this shard
+    if config.shard:
+        from assignmenttool.shard import select_shard
+        scores = select_shard(scores, *config.shard)
+
+    with Journal(config.journal, config.infile, config.resume) as journal, \
+            Archive(config.archive, journal) if config.archive else contextlib.nullcontext() as archive:
+        # Check everything that could abort the run before compiling anything
+        grades = preflight(config, journal, archive, scores, sheets, sheet_meta, participants, max_scores_sheet, filename_template)
+        if config.check_only:
+            print(f"[OK]\tNo problems found for {sum(len(sheet_grades.totals) for sheet_grades in grades.values())} documents")
+            return 0
+
+        # Render one LaTeX document per sheet and user
+        documents = []
+        for sheet in sheets:
+            if sheet not in grades:
+                print(f"No matching grades found for sheet {sheet}")
+                continue
+            with collector.phase('render'):
+                documents += render_documents(config, tex_template, filename_template, sheet, grades[sheet], participants, max_scores_sheet)
+
+        if not documents:
+            print("No matching grades found")
+            # The archive of an empty shard is still written for the merge
+            return 0 if config.shard else 1
+
+        # PDFs stored or mailed by the resumed run must match the documents
+        outdated = [ document for document in documents if journal.outdated(document.sheet, document.user, document.tex) ]
+        if outdated:
+            for document in outdated:
+                print(f'[FAILED]\t{document.user} [sheet {document.sheet}]: The document changed since its PDF was stored or mailed.')
+            raise AToolError(f"{len(outdated)} document(s) changed since the run recorded in '{config.journal}', cannot resume. Start a new run without --resume.")
+
+        return compile_documents(config, journal, archive, documents, template, sheets, participants)
+
+def report_failures(failures, label):
+    """Prints the reasons and pdflatex log excerpts of the documents that
+    failed to compile"""
+    if not failures:
+        return
+    print('\nDocuments that failed to compile:')
+    for document, error in failures:
+        print(f'\n  {label(document)}: {error}')
+        for line in error.log.splitlines():
+            print(f'    {line}')
+    print()
+
+def compile_documents(config, journal, archive, documents, template, sheets, participants):
+    """Compiles, stores and mails the rendered documents. PDFs are stored as
+    individual files or streamed into `archive`, if given."""
+    if config.mail:
+        from assignmenttool.mailer import FeedbackMailer
+    group = CompileGroup()
+
+    # Compile the documents in parallel, but handle the results in order so
+    # that the output stays deterministic
+    cache = None
+    if not config.no_cache:
+        cache = PDFCache(os.path.join(config.cache_dir, 'pdf'), config.cache_size, config.pdflatex_path, config.pdflatex_version)
+
+    # Precompile the template preamble into a format file shared by all
+    # documents. Without a cache, the format only lives for this run.
+    fmt = None
+    fmt_tmpdir = None
+    if not config.no_format:
+        if cache:
+            fmt_dir = os.path.join(config.cache_dir, 'fmt')
+        else:
+            fmt_dir = fmt_tmpdir = tempfile.mkdtemp(dir = config.build_dir)
+        with collector.phase('format'):
+            fmt = build_format(template, config.pdflatex, config.pdflatex_version, fmt_dir, config.compile_timeout, config.build_dir, group)
+        if fmt is None:
+            print('[WARN]\tFailed to precompile the template preamble, compiling full documents instead.')
+
+    # Compile, store and mail the documents as a pipeline. At most a few
+    # documents per job are in flight at any time, and every PDF is passed on
+    # as soon as it is available. Completed operations are recorded in the
+    # journal and skipped when resuming. Documents that fail to compile are
+    # reported at the end and do not affect the remaining documents.
+    store = not (config.no_local_file and config.mail)
+    label = lambda document : document.user if len(sheets) == 1 else f'{document.user} [sheet {document.sheet}]'
+    stats = CompileStats()
+    executor = None
+    failures = []
+    with collector.phase('pipeline'), \
+            FeedbackMailer(config, participants, journal) if config.mail else contextlib.nullcontext() as mailer:
+        todo = []
+        for document in documents:
+            if (store and not journal.done(document.sheet, document.user, 'store')) or (config.mail and not journal.done(document.sheet, document.user, 'mail')):
+                todo.append(document)
+            else:
+                print(f"[SKIP]\t{label(document)}")
+
+        def build(document):
+            # Reuse a PDF stored by a previous run if it only remains to be mailed
+            pdf = None if archive else journal.stored_pdf(document.sheet, document.user, document.outpath)
+            if pdf is not None:
+                return None, pdf
+            try:
+                return compileLaTeX(document.tex, config.pdflatex, config.debug, cache, stats, fmt, config.compile_timeout, config.compile_retries, config.build_dir, group)
+            except CompileError as e:
+                return e
+
+        try:
+            results = None
+            if config.cohort:
+                # Compile all documents as a single document, or one by one to
+                # isolate the failing documents
+                try:
+                    results = compile_cohort([ document.tex for document in todo ], config.pdflatex, config.debug, cache, stats, fmt, config.compile_timeout, config.compile_retries, config.build_dir, group)
+                except CompileError as e:
+                    print(f'[WARN]\tCompiling all documents at once failed, compiling them one by one: {e}')
+            if results is None:
+                executor = ThreadPoolExecutor(max_workers = config.jobs)
+                def compile_all():
+                    pending = deque()
+                    for document in todo:
+                        pending.append(executor.submit(build, document))
+                        if len(pending) > 2 * config.jobs:
+                            yield pending.popleft().result()
+                    while pending:
+                        yield pending.popleft().result()
+                results = compile_all()
+            for document, result in zip(todo, results):
+                if isinstance(result, CompileError):
+                    print(f"[FAILED]\t{label(document)}: {result}")
+                    failures.append((document, result))
+                    continue
+                tdir, pdf = result
+
+                # Store locally unless in mail only mode or already stored
+                if store and not journal.done(document.sheet, document.user, 'store'):
+                    pdf_digest = digest(pdf)
+                    if archive:
+                        archive.add(document.outpath, pdf, document.user, document.sheet, document.total, document.maxtotal, pdf_digest)
+                    else:
+                        if os.path.exists(document.outpath):
+                            raise AToolError(f"Output path '{document.outpath}' exists! Aborting!")
+                        with open(document.outpath, 'wb') as outfile:
+                            outfile.write(pdf)
+                    collector.count('bytes_written', len(pdf))
+                    journal.record(document.sheet, document.user, 'compile', sha256 = digest(document.tex))
+                    # Archived PDFs are recorded once the archive is complete
+                    if not archive:
+                        journal.record(document.sheet, document.user, 'store', sha256 = pdf_digest)
+                    if config.debug and tdir is None:
+                        print(f"[OK]\t{label(document)} [cached]")
+                    elif config.debug:
+                        print(f"[OK]\t{label(document)} [temp dir '{tdir}']")
+                    else:
+                        print(f"[OK]\t{label(document)}")
+
+                else:
+                    journal.record(document.sheet, document.user, 'compile', sha256 = digest(document.tex))
+
+                # Send out email if requested to do so and not sent before
+                if mailer and not journal.done(document.sheet, document.user, 'mail'):
+                    mailer.send(document.user, document.sheet, os.path.basename(document.outpath), pdf)
+
+            report_failures(failures, label)
+        finally:
+            # Do not start any further compilations after an error and stop
+            # the running ones, e.g. on Ctrl-C
+            group.cancel()
+            if executor:
+                executor.shutdown(wait = True, cancel_futures = True)
+            if fmt_tmpdir:
+                shutil.rmtree(fmt_tmpdir, ignore_errors = True)
+
+        print(f'Compiled {stats}')
+
+    if failures:
+        raise AToolError(f'Failed to compile {len(failures)} of {len(todo)} documents: {", ".join(label(document) for document, _ in failures)}')
     return 0
 
 ####################################################################################################
 
+def report_stats(config):
+    """Prints and / or writes the statistics of the run if requested"""
+    if config.stats:
+        print()
+        print(collector.table())
+    if config.stats_json:
+        try:
+            collector.write_json(config.stats_json)
+        except OSError as e:
+            print(f"Failed to write statistics to '{config.stats_json}': {e}")
+
 def main(argv=sys.argv):
     try:
+        if argv[1:2] == [ 'summary' ]:
+            from assignmenttool.summary import summarize
+            sys.exit(summarize(config.get_summary_config(argv[2:])))
+        if argv[1:2] == [ 'merge' ]:
+            from assignmenttool.shard import merge
+            sys.exit(merge(config.get_merge_config(argv[2:])))
         cfg = config.get_config()
-        process(cfg)
+        profiler = cProfile.Profile() if cfg.profile else None
+        try:
+            if profiler:
+                profiler.enable()
+            if cfg.watch:
+                from assignmenttool.watch import watch
+                watch(cfg)
+            else:
+                process(cfg)
+        finally:
+            if profiler:
+                profiler.disable()
+                profiler.dump_stats(cfg.profile)
+            report_stats(cfg)
     except AToolError as e:
         print(f'\nERROR: {e}')
         sys.exit(1)
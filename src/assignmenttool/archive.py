@@ -0,0 +1,207 @@
+# Copyright (c) 2020 Leon Kuchenbecker <leon.kuchenbecker@uni-tuebingen.de>
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+
+import csv
+import io
+import os
+import shutil
+import tarfile
+import time
+import warnings
+import zipfile
+
+from assignmenttool.errors import AToolError
+from assignmenttool.journal import digest
+
+# Name of the member listing the archived PDFs
+MANIFEST = 'manifest.csv'
+
+MANIFEST_COLUMNS = [ 'Username', 'Sheet', 'Score', 'MaxScore', 'File', 'SHA256' ]
+
+def member_name(path):
+    """Returns the archive member name for the output path `path`"""
+    return os.path.normpath(path).replace(os.sep, '/').lstrip('/')
+
+def read_archive(path):
+    """Yields the manifest entries of the archive at `path` as dicts together
+    with the archived PDFs. Raises an AToolError if the archive has no
+    manifest or a PDF does not match its hash."""
+    try:
+        if path.lower().endswith('.zip'):
+            archive = zipfile.ZipFile(path)
+            read    = archive.read
+        else:
+            archive = tarfile.open(path, 'r:*')
+            members = { member.name : member for member in archive.getmembers() }
+            read    = lambda name : archive.extractfile(members[name]).read()
+    except (OSError, zipfile.BadZipFile, tarfile.TarError) as e:
+        raise AToolError(f"Cannot read archive '{path}': {e}")
+    with archive:
+        try:
+            manifest = read(MANIFEST).decode('utf-8')
+        except KeyError:
+            raise AToolError(f"Archive '{path}' does not contain a manifest.")
+        for entry in csv.DictReader(io.StringIO(manifest)):
+            try:
+                pdf = read(entry['File'])
+            except KeyError:
+                raise AToolError(f"Archive '{path}' lacks '{entry['File']}' listed in its manifest.")
+            if digest(pdf) != entry['SHA256']:
+                raise AToolError(f"'{entry['File']}' in archive '{path}' does not match the hash in the manifest.")
+            yield entry, pdf
+
+class Archive:
+    """Writes the PDFs into a single ZIP or tar archive as they are produced,
+    together with a manifest listing the user, sheet, score and SHA-256
+    hash of every PDF. Existing ZIP and uncompressed tar archives are
+    appended to. The manifest is rewritten with all entries when the
+    archive is closed, superseding the one of a previous run.
+
+    The PDFs are written into a temporary copy of the archive, which only
+    replaces the archive once it was closed successfully. An interrupted run
+    thus leaves the previous archive intact. The added PDFs are recorded as
+    stored in `journal`, if given, only after the archive was replaced."""
+
+    def __init__(self, path, journal = None):
+        self.path     = path
+        self.tmppath  = path + '.tmp'
+        self.journal  = journal
+        self.handle   = None
+        self.names    = set()
+        self.manifest = []
+        self.added    = []
+
+        lower = path.lower()
+        if lower.endswith('.zip'):
+            self.kind = 'zip'
+        elif lower.endswith('.tar'):
+            self.kind = 'tar'
+        elif lower.endswith(('.tar.gz', '.tgz')):
+            self.kind = 'tar:gz'
+        else:
+            raise AToolError(f"Unsupported archive '{path}', use a .zip, .tar, .tar.gz or .tgz file.")
+
+        if os.path.exists(path):
+            if self.kind == 'tar:gz':
+                raise AToolError(f"Cannot append to the compressed archive '{path}'.")
+            self._read_existing()
+
+    def _read_existing(self):
+        try:
+            if self.kind == 'zip':
+                with zipfile.ZipFile(self.path) as archive:
+                    self.names = set(archive.namelist())
+                    manifest = archive.read(MANIFEST) if MANIFEST in self.names else None
+            else:
+                with tarfile.open(self.path, 'r') as archive:
+                    self.names = set(archive.getnames())
+                    manifest = archive.extractfile(MANIFEST).read() if MANIFEST in self.names else None
+        except (OSError, zipfile.BadZipFile, tarfile.TarError, KeyError) as e:
+            raise AToolError(f"Cannot read archive '{self.path}': {e}")
+        if manifest:
+            self.manifest = [ [ row[column] for column in MANIFEST_COLUMNS ] for row in csv.DictReader(io.StringIO(manifest.decode('utf-8'))) ]
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def __contains__(self, path):
+        return member_name(path) in self.names
+
+    def sha256(self, path):
+        """Returns the hash of the PDF archived as `path` according to the
+        manifest or None if it is not listed"""
+        name = member_name(path)
+        for row in self.manifest:
+            if row[4] == name:
+                return row[5]
+        return None
+
+    def _open(self):
+        try:
+            if os.path.exists(self.path):
+                shutil.copyfile(self.path, self.tmppath)
+            elif os.path.exists(self.tmppath):
+                # Left behind by an interrupted run
+                os.remove(self.tmppath)
+            if self.kind == 'zip':
+                self.handle = zipfile.ZipFile(self.tmppath, 'a')
+            else:
+                self.handle = tarfile.open(self.tmppath, 'a' if self.kind == 'tar' else 'w:gz')
+        except (OSError, zipfile.BadZipFile, tarfile.TarError) as e:
+            raise AToolError(f"Cannot open archive '{self.path}': {e}")
+
+    def _write(self, name, data, compress = False):
+        if self.kind == 'zip':
+            with warnings.catch_warnings():
+                # A rewritten manifest shadows the previous one
+                warnings.simplefilter('ignore', UserWarning)
+                self.handle.writestr(name, data, zipfile.ZIP_DEFLATED if compress else zipfile.ZIP_STORED)
+        else:
+            info       = tarfile.TarInfo(name)
+            info.size  = len(data)
+            info.mtime = int(time.time())
+            self.handle.addfile(info, io.BytesIO(data))
+
+    def add(self, path, pdf, user, sheet, score, max_score, sha256):
+        """Adds the PDF for `user` on `sheet` as `path` to the archive"""
+        if self.handle is None:
+            self._open()
+        name = member_name(path)
+        try:
+            self._write(name, pdf)
+        except OSError as e:
+            raise AToolError(f"Cannot write '{name}' to archive '{self.path}': {e}")
+        self.names.add(name)
+        self.manifest.append([ user, sheet, score, max_score, name, sha256 ])
+        self.added.append((sheet, user, sha256))
+
+    def close(self):
+        """Writes the manifest, closes the archive and replaces the previous
+        archive if anything was added. If the archive does not exist yet, an
+        archive with an empty manifest is created also if nothing was added."""
+        if self.handle is None:
+            if os.path.exists(self.path):
+                return
+            self._open()
+        out = io.StringIO()
+        writer = csv.writer(out)
+        writer.writerow(MANIFEST_COLUMNS)
+        writer.writerows(self.manifest)
+        try:
+            try:
+                self._write(MANIFEST, out.getvalue().encode('utf-8'), compress = True)
+            finally:
+                self.handle.close()
+                self.handle = None
+            fd = os.open(self.tmppath, os.O_RDONLY)
+            try:
+                os.fsync(fd)
+            finally:
+                os.close(fd)
+            os.replace(self.tmppath, self.path)
+        except (OSError, tarfile.TarError) as e:
+            raise AToolError(f"Cannot write archive '{self.path}': {e}")
+        if self.journal:
+            for sheet, user, sha256 in self.added:
+                self.journal.record(sheet, user, 'store', sha256 = sha256)
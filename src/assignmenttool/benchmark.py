@@ -0,0 +1,331 @@
+# Copyright (c) 2020 Leon Kuchenbecker <leon.kuchenbecker@uni-tuebingen.de>
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+
+"""Benchmark harness for assignment-tool. Generates a synthetic workbook and
+times the individual phases of a run. Mails are delivered to a local SMTP
+sink and, unless a real pdflatex is specified, documents are compiled using
+a stub that mimics pdflatex without requiring a TeX installation."""
+
+import argparse
+import json
+import os
+import platform
+import random
+import shutil
+import socketserver
+import statistics
+import stat
+import sys
+import tempfile
+import threading
+import time
+
+from concurrent.futures import ThreadPoolExecutor
+
+import pandas as pd
+
+import assignmenttool
+from assignmenttool import grading, SMTPClient
+from assignmenttool.latex import compileLaTeX, build_format
+from assignmenttool.template import Template
+from assignmenttool.workbook import load_workbook
+
+# A compact feedback template using the same macros as the example template
+TEMPLATE = r"""\documentclass[12pt,a4paper]{article}
+\usepackage[T1]{fontenc}
+\usepackage[margin=2cm]{geometry}
+\setlength\parindent{0mm}
+\newcommand\beforeGlobalComments{\subsection*{General Remarks}\begin{itemize}}
+\newcommand\afterGlobalComments{\end{itemize}}
+\newcommand\globalComment[1]{\item #1}
+\newcommand\beforeComments{\begin{itemize}}
+\newcommand\afterComments{\end{itemize}}
+\newcommand\comment[1]{\item #1}
+\newcommand\newtask[1]{\subsection*{Exercise #1}}
+\newcommand\scoreTask[5]{#2.#3\dotfill #4 of #5
+
+}
+\begin{document}
+{\large Scores for Exercise Sheet §§sheetnr§§\hfill Total: §§total§§ of §§maxtotal§§}
+
+{\large §§fullname§§}
+
+{Tutor: §§tutorname§§}
+
+§§global§§
+
+§§tasks§§
+\end{document}
+"""
+
+# Stub for pdflatex. Writes a valid PDF with one blank page per document, as
+# well as the .log, .aux and (for the cohort engine) .pages files.
+STUB = r'''
+import os, sys, time
+
+def pdf(pages):
+    objs  = [ '<< /Type /Catalog /Pages 2 0 R >>',
+              '<< /Type /Pages /Kids [%s] /Count %d >>' % (' '.join('%d 0 R' % (3 + i) for i in range(pages)), pages) ]
+    objs += [ '<< /Type /Page /Parent 2 0 R /MediaBox [0 0 595 842] >>' ] * pages
+    out, offsets = b'%PDF-1.4\n', []
+    for num, obj in enumerate(objs):
+        offsets.append(len(out))
+        out += b'%d 0 obj\n%s\nendobj\n' % (num + 1, obj.encode())
+    xref = len(out)
+    out += b'xref\n0 %d\n0000000000 65535 f \n' % (len(objs) + 1)
+    out += b''.join(b'%010d 00000 n \n' % offset for offset in offsets)
+    out += b'trailer\n<< /Size %d /Root 1 0 R >>\nstartxref\n%d\n%%%%EOF\n' % (len(objs) + 1, xref)
+    return out
+
+args = sys.argv[1:]
+if '--version' in args:
+    print('pdfTeX 3.141592653 (assignment-tool benchmark stub)')
+    sys.exit(0)
+time.sleep(float(os.environ.get('ATOOL_STUB_DELAY', '0')))
+files = [ arg for arg in args if not arg.startswith('-') and not arg.startswith('&') and arg != 'batchmode' ]
+job   = files[-1][:-4] if files[-1].endswith('.tex') else files[-1]
+name  = next((arg.split('=', 1)[1] for arg in args if arg.startswith('-jobname=')), job)
+with open(job + '.tex') as infile:
+    src = infile.read()
+if '-ini' in args:
+    open(name + '.fmt', 'wb').write(b'stub format')
+    sys.exit(0)
+pages = 1
+if 'atoolpages' in src:
+    pages = src.count('\\atoolnext') - 2
+    open(name + '.pages', 'w').write(''.join('%d\n' % i for i in range(pages + 1)))
+open(name + '.aux', 'w').write('\\relax \n\\gdef \\@abspage@last{%d}\n' % pages)
+open(name + '.log', 'w').write('This is pdfTeX (stub)\nOutput written on %s.pdf (%d pages).\n' % (name, pages))
+open(name + '.pdf', 'wb').write(pdf(pages))
+'''
+
+####################################################################################################
+
+def generate_workbook(path, students = 100, sheets = 1, tasks = 4, subtasks = 3, comments = 2, seed = 0):
+    """Writes a synthetic workbook in the format of examples/ExampleSheet.xlsx.
+    `comments` is the average number of comments per student and sheet."""
+    rng   = random.Random(seed)
+    users = [ f'user{num:05d}' for num in range(students) ]
+
+    participants = pd.DataFrame({
+        'Name'     : [ f'Student {num}' for num in range(students) ],
+        'Username' : users,
+        'E-Mail'   : [ f'{user}@students.example.org' for user in users ],
+        })
+
+    meta = [ (sheet, task, subtask, rng.choice([ 1, 2, 2.5, 3, 4 ]))
+            for sheet in range(1, sheets + 1) for task in range(1, tasks + 1) for subtask in range(1, subtasks + 1) ]
+    sheet_meta = pd.DataFrame(meta, columns = [ 'Sheet', 'Task', 'Subtask', 'MaxScore' ])
+
+    rows = []
+    for user in users:
+        for sheet, task, subtask, max_score in meta:
+            rows.append((user, sheet, task, subtask, 'SCORE', rng.randint(0, int(max_score * 2)) / 2))
+        for sheet in range(1, sheets + 1):
+            for _ in range(int(comments) + (rng.random() < comments % 1)):
+                if rng.random() < 0.2:
+                    rows.append((user, sheet, None, None, 'COMMENT', 'Please submit your solutions as a single PDF file.'))
+                else:
+                    rows.append((user, sheet, rng.randint(1, tasks), rng.randint(1, subtasks), 'COMMENT', 'The correct answer would have been 42.'))
+    grading_rows = pd.DataFrame(rows, columns = [ 'Username', 'Sheet', 'Task', 'Subtask', 'Type', 'Value' ])
+
+    with pd.ExcelWriter(path) as writer:
+        participants.to_excel(writer, sheet_name = 'Participants', index = False)
+        sheet_meta.to_excel(writer, sheet_name = 'Sheets', index = False)
+        grading_rows.to_excel(writer, sheet_name = 'Grading', index = False)
+
+class SMTPSink:
+    """Minimal SMTP server on localhost accepting and discarding all mail"""
+
+    class Handler(socketserver.StreamRequestHandler):
+        def handle(self):
+            sink = self.server.sink
+            self.wfile.write(b'220 localhost assignment-tool benchmark sink\r\n')
+            data = None
+            for line in self.rfile:
+                if data is not None:
+                    if line == b'.\r\n':
+                        with sink.lock:
+                            sink.messages += 1
+                            sink.bytes    += len(data)
+                        data = None
+                        self.wfile.write(b'250 OK\r\n')
+                    else:
+                        data += line
+                    continue
+                command = line[:4].upper()
+                if command == b'EHLO':
+                    self.wfile.write(b'250-localhost\r\n250 AUTH PLAIN LOGIN\r\n')
+                elif command == b'AUTH':
+                    self.wfile.write(b'235 OK\r\n')
+                elif command == b'DATA':
+                    data = b''
+                    self.wfile.write(b'354 End data with <CR><LF>.<CR><LF>\r\n')
+                elif command == b'QUIT':
+                    self.wfile.write(b'221 Bye\r\n')
+                    return
+                else:
+                    self.wfile.write(b'250 OK\r\n')
+
+    def __init__(self):
+        self.lock     = threading.Lock()
+        self.messages = 0
+        self.bytes    = 0
+        self.server   = socketserver.ThreadingTCPServer(('127.0.0.1', 0), self.Handler)
+        self.server.daemon_threads = True
+        self.server.sink = self
+        self.port     = self.server.server_address[1]
+        self.thread   = threading.Thread(target = self.server.serve_forever, daemon = True)
+
+    def __enter__(self):
+        self.thread.start()
+        return self
+
+    def __exit__(self, *args):
+        self.server.shutdown()
+        self.server.server_close()
+
+def write_stub(directory):
+    """Writes the pdflatex stub to `directory` and returns its path"""
+    path = os.path.join(directory, 'pdflatex')
+    with open(path, 'w') as outfile:
+        outfile.write(f'#!{sys.executable}\n' + STUB)
+    os.chmod(path, os.stat(path).st_mode | stat.S_IXUSR | stat.S_IXGRP | stat.S_IXOTH)
+    return path
+
+def timed(results, phase, repeat, func):
+    """Runs `func` `repeat` times, records the timings under `phase` and
+    returns the result of the last run"""
+    runs = []
+    for _ in range(repeat):
+        start  = time.perf_counter()
+        result = func()
+        runs.append(time.perf_counter() - start)
+    results[phase] = { 'min' : min(runs), 'median' : statistics.median(runs), 'runs' : runs }
+    print(f'{phase:<20} {min(runs):10.4f}s', file = sys.stderr)
+    return result
+
+def version():
+    try:
+        from importlib.metadata import version
+        return version('assignmenttool')
+    except Exception:
+        return 'unknown'
+
+####################################################################################################
+
+def run(args):
+    tdir = tempfile.mkdtemp()
+    try:
+        pdflatex = args.pdflatex or write_stub(tdir)
+        infile   = os.path.join(tdir, 'bench.xlsx')
+        generate_workbook(infile, args.students, args.sheets, args.tasks, args.subtasks, args.comments, args.seed)
+
+        phases = {}
+
+        # Reading the workbook, with and without the Parquet sidecar
+        workbook = timed(phases, 'read_scores', args.repeat, lambda : load_workbook(infile))
+        try:
+            import pyarrow
+            load_workbook(infile, os.path.join(tdir, 'workbook'))
+            timed(phases, 'read_scores_cached', args.repeat, lambda : load_workbook(infile, os.path.join(tdir, 'workbook')))
+        except ImportError:
+            pass
+
+        participants     = workbook.participants.set_index('Username')
+        max_scores_sheet = workbook.sheets.groupby('Sheet')['MaxScore'].sum()
+        sheets           = range(1, args.sheets + 1)
+
+        # Validation and aggregation
+        grades = timed(phases, 'aggregate', args.repeat, lambda : {
+            sheet : grading.aggregate(workbook.grading[workbook.grading.Sheet == sheet], workbook.sheets) for sheet in sheets })
+
+        # Template rendering
+        config = argparse.Namespace(tutor_name = 'Alice Teacher', raw_comments = False)
+        tex_template      = Template(TEMPLATE)
+        filename_template = Template('Exercise§§sheetnr§§.§§username§§.feedback.pdf')
+        documents = timed(phases, 'render', args.repeat, lambda : [ document for sheet in sheets
+            for document in assignmenttool.render_documents(config, tex_template, filename_template, sheet, grades[sheet], participants, max_scores_sheet) ])
+
+        # Compilation
+        version_str = 'benchmark'
+        fmt = None
+        if not args.no_format:
+            fmt = timed(phases, 'format', 1, lambda : build_format(TEMPLATE, pdflatex, version_str, os.path.join(tdir, 'fmt')))
+        def compile_all():
+            with ThreadPoolExecutor(max_workers = args.jobs) as executor:
+                return list(executor.map(lambda document : compileLaTeX(document.tex, pdflatex, fmt = fmt)[1], documents))
+        pdfs = timed(phases, 'compile', args.repeat, compile_all)
+
+        # Sending mails over a single persistent session
+        with SMTPSink() as sink:
+            def send_all():
+                with SMTPClient.SMTPClient(hostname = '127.0.0.1', port = sink.port) as smtp:
+                    for document, pdf in zip(documents, pdfs):
+                        smtp.sendMessage(
+                                sender       = ('Alice Teacher', 'alice@example.org'),
+                                recipients   = (document.user, f'{document.user}@students.example.org'),
+                                subject      = f'Feedback for exercise sheet {document.sheet}',
+                                message_text = 'Please find your feedback attached.',
+                                attachments  = { os.path.basename(document.outpath) : pdf })
+            timed(phases, 'send', args.repeat, send_all)
+            sent_bytes = sink.bytes
+
+        return {
+                'version'    : version(),
+                'python'     : platform.python_version(),
+                'pandas'     : pd.__version__,
+                'platform'   : platform.platform(),
+                'timestamp'  : time.strftime('%Y-%m-%dT%H:%M:%S%z'),
+                'pdflatex'   : args.pdflatex or 'stub',
+                'parameters' : { key : value for key, value in vars(args).items() if key != 'output' },
+                'documents'  : len(documents),
+                'sent_bytes' : sent_bytes,
+                'phases'     : phases,
+                }
+    finally:
+        shutil.rmtree(tdir, ignore_errors = True)
+
+def main(argv = None):
+    parser = argparse.ArgumentParser(description = 'Benchmark the phases of an assignment-tool run on a synthetic workbook.')
+    parser.add_argument('--students', type = int, default = 100, help = 'Number of students (default: 100).')
+    parser.add_argument('--sheets', type = int, default = 1, help = 'Number of sheets (default: 1).')
+    parser.add_argument('--tasks', type = int, default = 4, help = 'Number of tasks per sheet (default: 4).')
+    parser.add_argument('--subtasks', type = int, default = 3, help = 'Number of subtasks per task (default: 3).')
+    parser.add_argument('--comments', type = float, default = 2, help = 'Average number of comments per student and sheet (default: 2).')
+    parser.add_argument('--seed', type = int, default = 0, help = 'Random seed for the workbook generator (default: 0).')
+    parser.add_argument('--jobs', '-j', type = int, default = os.cpu_count() or 1, help = 'Number of parallel compilations (default: number of CPU cores).')
+    parser.add_argument('--pdflatex', type = str, help = 'Use this pdflatex instead of the stub.')
+    parser.add_argument('--no-format', action = 'store_true', help = 'Do not precompile the template preamble.')
+    parser.add_argument('--repeat', type = int, default = 3, help = 'Number of repetitions per phase (default: 3).')
+    parser.add_argument('--output', '-o', type = str, help = 'Write the results as JSON to this file instead of stdout.')
+    args = parser.parse_args(argv)
+
+    results = run(args)
+    if args.output:
+        with open(args.output, 'w') as outfile:
+            json.dump(results, outfile, indent = 2)
+    else:
+        json.dump(results, sys.stdout, indent = 2)
+        print()
+
+if __name__ == '__main__':
+    main()
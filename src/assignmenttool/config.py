@@ -20,46 +20,154 @@
 
 import argparse
 import configparser
-import subprocess
+import importlib.util
 import os
 
 from assignmenttool.errors import AToolError
+from assignmenttool.latex import probe_pdflatex
+from assignmenttool.pdfcache import default_cache_dir
+
+def parse_sheets(spec):
+    """Parses a sheet specification such as '3', '1-12', '1,3,5-7' or 'all'.
+    Returns a sorted list of sheet numbers or None for all sheets."""
+    if spec.strip().lower() == 'all':
+        return None
+    sheets = set()
+    try:
+        for item in spec.split(','):
+            if '-' in item:
+                first, last = item.split('-')
+                if int(first) > int(last):
+                    raise ValueError
+                sheets.update(range(int(first), int(last) + 1))
+            else:
+                sheets.add(int(item))
+    except ValueError:
+        raise AToolError(f"Invalid sheet specification '{spec}'. Use e.g. '3', '1-12', '1,3,5' or 'all'.")
+    return sorted(sheets)
+
+def add_mail_arguments(parser):
+    """Adds the mail related arguments to `parser`"""
+    mail = parser.add_argument_group('mail releated settings')
+    mail.add_argument('--mail', action = 'store_true', help = 'Send out the feedback PDFs to the participants via email.')
+    mail.add_argument('--mail-smtp-host', type = str, help = 'Hostname of the SMTP server to use for mail submission.')
+    mail.add_argument('--mail-smtp-port', type = str, help = 'Hostname of the SMTP server to use for mail submission. Default: 587.')
+    mail.add_argument('--mail-smtp-user', type = str, help = 'Username to use to authenticate at the SMTP server.')
+    mail.add_argument('--mail-smtp-no-tls', action = 'store_true', help = 'Use SMTP without TLS.')
+    mail.add_argument('--mail-max-messages', type = int, metavar = '<n>', help = 'Maximum number of messages to send over a single SMTP connection before reconnecting. Default: unlimited.')
+    mail.add_argument('--mail-connections', type = int, metavar = '<n>', help = 'Number of SMTP connections to send mails over in parallel. Default: 1.')
+    mail.add_argument('--mail-rate', type = float, metavar = '<n>', help = 'Maximum number of mails to send per second. Default: unlimited.')
+    mail.add_argument('--mail-sender-name', type = str, help = 'Sender name to use when sending out mails.')
+    mail.add_argument('--mail-sender-address', type = str, help = 'Sender address to use when sending out mails.')
+    mail.add_argument('--mail-bcc', type = str, nargs = '+', help = 'BCC recipient to add to every sent out email.')
+    mail.add_argument('--mail-bcc-digest', action = 'store_true', help = 'Instead of adding the BCC recipients to every email, send them a single email with an archive of all PDFs and a delivery report at the end.')
+    mail.add_argument('--mail-subject', type = str, help = 'Subject for outgoing emails to participants. May contain variables §§username§§, §§name§§ and §§sheetnr§§.')
+    mail.add_argument('--mail-template', type = str, help = 'Path to the email body template for outgoing emails to participants. The template itself may contain variables §§username§§, §§name§§, §§sheetnr§§ and §§tutorname§§.')
+    return mail
+
+def parse_shard(spec):
+    """Parses a shard specification such as '2/4'. Returns the zero-based
+    shard index and the number of shards."""
+    try:
+        index, count = ( int(part) for part in spec.split('/') )
+    except ValueError:
+        raise AToolError(f"Invalid shard specification '{spec}'. Use e.g. '2/4' for the second of four shards.")
+    if not 1 <= index <= count:
+        raise AToolError(f"Invalid shard specification '{spec}'. The shard must be between 1 and the number of shards.")
+    return index - 1, count
 
 def config_from_cli():
     """Handle configuration passed through the command line"""
 
-    parser = argparse.ArgumentParser()
+    parser = argparse.ArgumentParser(epilog = "Run 'assignment-tool summary -h' for exporting statistics of all participants or 'assignment-tool merge -h' for combining the archives of several shards instead.")
     parser.add_argument('infile', type = str, metavar = '<sheetpath>', help = 'Path to the Excel file.')
-    parser.add_argument('sheet', type = int, help = 'Sheet number to process')
+    parser.add_argument('sheet', type = str, help = "Sheet number(s) to process, e.g. '3', '1-12', '1,3,5' or 'all'")
 
     general = parser.add_argument_group('general settings')
     general.add_argument('--tex-template', type = str, metavar = '<texpath>', help = 'Path to the LaTeX template.')
     general.add_argument('--tutor-name', type = str, metavar = '<tutorname>', help = 'Name of the correcting tutor. Will be blank if not specified but used in the template.')
     general.add_argument('--pdflatex', type = str, metavar = '<pdflatexpath>', help = 'pdflatex command to use (default: pdflatex).', default='pdflatex')
     general.add_argument('--pdf-filename', type = str, metavar = '<name>', help = 'Output filename of the PDF feedback. May contain variables §§username§§, §§name§§ and §§sheetnr§§.')
+    general.add_argument('--archive', type = str, metavar = '<path>', help = 'Write all PDFs into this .zip, .tar or .tar.gz archive together with a manifest instead of individual files. Existing .zip and .tar archives are appended to.')
     general.add_argument('--no-local-file', action = 'store_true', help = 'If --mail is specified, do not store PDFs locally.')
+    general.add_argument('--raw-comments', action = 'store_true', help = 'Pass comments to LaTeX verbatim instead of escaping LaTeX special characters.')
+    general.add_argument('--no-format', action = 'store_true', help = 'Do not precompile the preamble of the LaTeX template into a format file.')
+    general.add_argument('--cohort', action = 'store_true', help = 'Compile the documents of all participants as a single LaTeX document and split the resulting PDF (requires pypdf).')
+    general.add_argument('--jobs', '-j', type = int, metavar = '<n>', help = 'Number of LaTeX documents to compile in parallel (default: number of CPU cores).')
+    general.add_argument('--compile-timeout', type = float, metavar = '<seconds>', help = 'Stop pdflatex if a single run takes longer than this (default: 120, 0 for no limit).')
+    general.add_argument('--compile-retries', type = int, metavar = '<n>', help = 'Number of times to retry compiling a document after a timeout (default: 1).')
+    general.add_argument('--build-dir', type = str, metavar = '<path>', help = 'Directory to create the temporary LaTeX build directories in, e.g. a tmpfs such as /dev/shm (default: system temp directory).')
+    general.add_argument('--journal', type = str, metavar = '<path>', help = 'Path of the journal recording completed operations (default: assignment.journal).')
+    general.add_argument('--resume', action = 'store_true', help = 'Resume the run recorded in the journal, skipping PDFs already stored and mails already sent.')
+    general.add_argument('--check-only', action = 'store_true', help = 'Only check the Excel file, the participants and the output paths for problems without compiling any PDFs.')
+    general.add_argument('--shard', type = str, metavar = '<i>/<n>', help = "Only process the i-th of n disjoint shards of the participants, e.g. '2/4'. Combine the archives of all shards using 'assignment-tool merge'.")
+    general.add_argument('--watch', action = 'store_true', help = 'Keep running and regenerate the PDFs of participants whose grades change whenever the Excel file or LaTeX template is modified. Existing PDFs are overwritten.')
     parser.add_argument_group(general)
 
-    mail = parser.add_argument_group('mail releated settings')
-    mail.add_argument('--mail', action = 'store_true', help = 'Send out the feedback PDFs to the participants via email.')
-    mail.add_argument('--mail-smtp-host', type = str, help = 'Hostname of the SMTP server to use for mail submission.')
-    mail.add_argument('--mail-smtp-port', type = str, help = 'Hostname of the SMTP server to use for mail submission. Default: 587.')
-    mail.add_argument('--mail-smtp-user', type = str, help = 'Username to use to authenticate at the SMTP server.')
-    mail.add_argument('--mail-smtp-no-tls', action = 'store_true', help = 'Use SMTP without TLS.')
-    mail.add_argument('--mail-sender-name', type = str, help = 'Sender name to use when sending out mails.')
-    mail.add_argument('--mail-sender-address', type = str, help = 'Sender address to use when sending out mails.')
-    mail.add_argument('--mail-bcc', type = str, nargs = '+', help = 'BCC recipient to add to every sent out email.')
-    mail.add_argument('--mail-subject', type = str, help = 'Subject for outgoing emails to participants. May contain variables §§username§§, §§name§§ and §§sheetnr§§.')
-    mail.add_argument('--mail-template', type = str, help = 'Path to the email body template for outgoing emails to participants. The template itself may contain variables §§username§§, §§name§§, §§sheetnr§§ and §§tutorname§§.')
+    cache = parser.add_argument_group('cache settings')
+    cache.add_argument('--no-cache', action = 'store_true', help = 'Do not reuse or store compiled PDFs, preamble formats, parsed Excel files and the pdflatex version in the cache.')
+    cache.add_argument('--cache-dir', type = str, metavar = '<path>', help = f'Cache directory (default: {default_cache_dir()}).')
+    cache.add_argument('--cache-size', type = int, metavar = '<MB>', help = 'Maximum size of the PDF cache in megabytes (default: 512).')
+
+    mail = add_mail_arguments(parser)
 
     dev = parser.add_argument_group('developer settings')
     dev.add_argument('--debug', action = 'store_true', help = 'Do not remove temporary LaTeX build folder. Print path instead.')
+    dev.add_argument('--stats', action = 'store_true', help = 'Print wall times, counters and latency percentiles of the run.')
+    dev.add_argument('--stats-json', type = str, metavar = '<path>', help = 'Write wall times, counters and latency percentiles of the run as JSON.')
+    dev.add_argument('--profile', type = str, metavar = '<path>', help = 'Profile the run using cProfile and write the profile to this file.')
 
     parser.add_argument_group(mail)
     config = parser.parse_args()
 
     return config
 
+def summary_config_from_cli(args):
+    """Handle configuration of the summary command passed through the command line"""
+
+    parser = argparse.ArgumentParser(prog = 'assignment-tool summary', description = 'Export per-sheet and per-task statistics and the total scores of all participants.')
+    parser.add_argument('infile', type = str, metavar = '<sheetpath>', help = 'Path to the Excel file.')
+    parser.add_argument('--output', '-o', type = str, metavar = '<path>', help = 'Write the statistics to this Excel file (*.xlsx) or as CSV files into this directory instead of printing them.')
+    parser.add_argument('--pass-threshold', type = float, metavar = '<percent>', help = 'Percentage of the maximum total score required to pass.')
+    parser.add_argument('--no-cache', action = 'store_true', help = 'Do not reuse or store the parsed Excel file in the cache.')
+    parser.add_argument('--cache-dir', type = str, metavar = '<path>', help = f'Cache directory (default: {default_cache_dir()}).')
+    return parser.parse_args(args)
+
+def get_summary_config(args):
+    """Obtains and checks the configuration of the summary command"""
+    config = summary_config_from_cli(args)
+    if config.pass_threshold is not None and not 0 <= config.pass_threshold <= 100:
+        raise AToolError('The pass threshold must be a percentage between 0 and 100.')
+    if not config.cache_dir:
+        config.cache_dir = default_cache_dir()
+    return config
+
+def merge_config_from_cli(args):
+    """Handle configuration of the merge command passed through the command line"""
+
+    parser = argparse.ArgumentParser(prog = 'assignment-tool merge', description = 'Combine the archives written by several shards into a single archive and optionally mail the PDFs to the participants.')
+    parser.add_argument('output', type = str, metavar = '<archive>', help = 'Path of the combined .zip, .tar or .tar.gz archive.')
+    parser.add_argument('inputs', type = str, metavar = '<shard archive>', nargs = '+', help = 'Archives written by the individual shards using --archive.')
+    parser.add_argument('--workbook', type = str, metavar = '<sheetpath>', help = 'Path to the Excel file. Required for --mail. If given, participants graded on the archived sheets but missing from all shards are reported.')
+    parser.add_argument('--tutor-name', type = str, metavar = '<tutorname>', help = 'Name of the correcting tutor, used in the email template.')
+    parser.add_argument('--journal', type = str, metavar = '<path>', default = 'assignment.merge.journal', help = 'Path of the journal recording sent mails (default: assignment.merge.journal).')
+    parser.add_argument('--resume', action = 'store_true', help = 'Resume the merge recorded in the journal, skipping PDFs already merged and mails already sent.')
+    add_mail_arguments(parser)
+    return parser.parse_args(args)
+
+def get_merge_config(args):
+    """Obtains and checks the configuration of the merge command from CLI and
+    RC file(s)"""
+    config = merge_config_from_cli(args)
+    vars(config)['mail_smtp_pass'] = None
+    read_rc(config)
+    if config.tutor_name is None:
+        config.tutor_name = ''
+    if config.mail and not config.workbook:
+        raise AToolError('When using --mail, --workbook must be specified.')
+    check_mail_config(config)
+    return config
+
 def read_rc(config):
     """Complements config specified by `conf` with values from the RC file(s) if not set in `conf`"""
 
@@ -73,17 +181,28 @@ def read_rc(config):
             ('tutor_name', 'General', 'TutorName'),
             ('pdflatex', 'General', 'PDFLaTeX'),
             ('pdf_filename', 'General', 'PDFFilename'),
+            ('jobs', 'General', 'Jobs'),
+            ('journal', 'General', 'Journal'),
+            ('archive', 'General', 'Archive'),
+            ('compile_timeout', 'General', 'CompileTimeout'),
+            ('compile_retries', 'General', 'CompileRetries'),
+            ('build_dir', 'General', 'BuildDir'),
+            ('cache_dir', 'Cache', 'Directory'),
+            ('cache_size', 'Cache', 'Size'),
             ('mail_smtp_host', 'Mail', 'SMTPHost'),
             ('mail_smtp_port', 'Mail', 'SMTPPort'),
             ('mail_smtp_user', 'Mail', 'SMTPUser'),
             ('mail_smtp_pass', 'Mail', 'SMTPPass'),
+            ('mail_max_messages', 'Mail', 'MaxMessagesPerConnection'),
+            ('mail_connections', 'Mail', 'Connections'),
+            ('mail_rate', 'Mail', 'Rate'),
             ('mail_bcc', 'Mail', 'BCC'),
             ('mail_subject', 'Mail', 'Subject'),
             ('mail_template', 'Mail', 'Template'),
             ('mail_sender_name', 'Mail', 'SenderName'),
             ('mail_sender_address', 'Mail', 'SenderAddress'),
             ]:
-        if vars(config)[cli_arg] is None:
+        if cli_arg in vars(config) and vars(config)[cli_arg] is None:
             try:
                 vars(config)[cli_arg] = configfile[conf_group][conf_key]
             except KeyError:
@@ -93,9 +212,14 @@ def read_rc(config):
     for cli_arg, conf_group, conf_key in [
             ('no_local_file', 'General', 'NoLocalFile'),
             ('debug', 'General', 'Debug'),
+            ('no_format', 'General', 'NoFormat'),
+            ('raw_comments', 'General', 'RawComments'),
+            ('cohort', 'General', 'Cohort'),
+            ('no_cache', 'Cache', 'NoCache'),
             ('mail_smtp_no_tls', 'Mail', 'NoTLS'),
+            ('mail_bcc_digest', 'Mail', 'BCCDigest'),
             ]:
-        if vars(config)[cli_arg] is False:
+        if cli_arg in vars(config) and vars(config)[cli_arg] is False:
             try:
                 vars(config)[cli_arg] = True if configfile[conf_group][conf_key] in ['yes', 'y', 'Yes', 'YES', 'True', 'TRUE', 'true', '1'] else False
             except KeyError:
@@ -106,41 +230,38 @@ def read_rc(config):
     for cli_arg, conf_group, conf_key in [
             ('mail_bcc', 'Mail', 'SMTPBCC')
             ]:
-        if vars(config)[cli_arg] is None:
+        if cli_arg in vars(config) and vars(config)[cli_arg] is None:
             try:
                 vars(config)[cli_arg] = [ e.strip() for e in configfile[conf_group][conf_key].split(',') ]
             except KeyError:
                 pass
 
-def get_config():
-    """Obtains and checks runtime configuration from CLI and RC file(s)"""
-
-    # Read CLI config
-    config = config_from_cli()
-    vars(config)['mail_smtp_pass'] = None
-
-    # Complement with RC config
-    read_rc(config)
-
-    # Check if template was specified
-    if not config.tex_template:
-        raise AToolError('No LaTeX template was specified. Use --tex-template or specify the path in th RC file.')
-
-    # Check if pdflatex works
-    ret = subprocess.run([config.pdflatex, '--version'], stdout = subprocess.PIPE, stderr = subprocess.PIPE)
-    if ret.returncode != 0:
-        raise AToolError(f"Failed to execute pdflatex ({config.pdflatex}). Please specify the path to the pdflatex binary using --pdflatex")
-
-    # Default to blank tutor name
-    if config.tutor_name is None:
-        config.tutor_name = ''
+def check_mail_config(config):
+    """Applies the defaults of and checks the mail related configuration"""
 
     # Default to 587 as SMTP submission port
     if not config.mail_smtp_port:
         config.mail_smtp_port = 587
 
-    if not config.pdf_filename:
-        config.pdf_filename='Exercise§§sheetnr§§.§§username§§.feedback.pdf'
+    # Default to an unlimited number of messages per SMTP connection
+    if config.mail_max_messages is not None:
+        try:
+            config.mail_max_messages = int(config.mail_max_messages)
+        except ValueError:
+            raise AToolError(f"Invalid number of messages per connection '{config.mail_max_messages}'.")
+
+    # Default to a single SMTP connection without rate limit
+    if config.mail_connections is None:
+        config.mail_connections = 1
+    try:
+        config.mail_connections = int(config.mail_connections)
+        config.mail_rate = float(config.mail_rate) if config.mail_rate is not None else None
+    except ValueError:
+        raise AToolError('Invalid number of SMTP connections or mail rate.')
+    if config.mail_connections < 1:
+        raise AToolError('The number of SMTP connections must be at least 1.')
+    if config.mail_rate is not None and config.mail_rate <= 0:
+        raise AToolError('The mail rate must be positive.')
 
     # Check if mail config is present if requested
     if config.mail:
@@ -154,11 +275,91 @@ def get_config():
                 ]:
             if not vars(config)[param[2:].replace('-','_')]:
                 raise AToolError(f'When using --mail, {param} must be specified.')
+        if config.mail_bcc_digest and not config.mail_bcc:
+            raise AToolError('When using --mail-bcc-digest, --mail-bcc must be specified.')
         # Read the mail template
         try:
             with open(config.mail_template, 'r') as infile:
-                config.mail_template_text = infile.read().replace('§§tutorname§§', config.tutor_name)
+                config.mail_template_text = infile.read()
         except Exception as e:
             raise AToolError(f"Failed to open mail template '{config.mail_template}': {e}")
 
+def get_config():
+    """Obtains and checks runtime configuration from CLI and RC file(s)"""
+
+    # Read CLI config
+    config = config_from_cli()
+    vars(config)['mail_smtp_pass'] = None
+
+    # Complement with RC config
+    read_rc(config)
+
+    # Parse sheet specification
+    config.sheets = parse_sheets(config.sheet)
+
+    # Check if template was specified
+    if not config.tex_template:
+        raise AToolError('No LaTeX template was specified. Use --tex-template or specify the path in th RC file.')
+
+    # Default to blank tutor name
+    if config.tutor_name is None:
+        config.tutor_name = ''
+
+    # Default to one compilation job per CPU core
+    if config.jobs is None:
+        config.jobs = os.cpu_count() or 1
+    try:
+        config.jobs = int(config.jobs)
+    except ValueError:
+        raise AToolError(f"Invalid number of jobs '{config.jobs}'.")
+    if config.jobs < 1:
+        raise AToolError('The number of jobs must be at least 1.')
+
+    # Limit pdflatex runs to two minutes and retry once by default
+    if config.compile_timeout is None:
+        config.compile_timeout = 120
+    if config.compile_retries is None:
+        config.compile_retries = 1
+    try:
+        config.compile_timeout = float(config.compile_timeout) or None
+        config.compile_retries = int(config.compile_retries)
+    except ValueError:
+        raise AToolError('Invalid compile timeout or number of compile retries.')
+    if (config.compile_timeout is not None and config.compile_timeout < 0) or config.compile_retries < 0:
+        raise AToolError('The compile timeout and the number of compile retries must not be negative.')
+    if config.build_dir and not os.path.isdir(config.build_dir):
+        raise AToolError(f"Build directory '{config.build_dir}' does not exist.")
+
+    # PDF cache defaults
+    if not config.cache_dir:
+        config.cache_dir = default_cache_dir()
+    if config.cache_size is None:
+        config.cache_size = 512
+    try:
+        config.cache_size = int(config.cache_size) * 1024 * 1024
+    except ValueError:
+        raise AToolError(f"Invalid cache size '{config.cache_size}'.")
+
+    # Shards keep separate journals in case they share a working directory
+    config.shard = parse_shard(config.shard) if config.shard else None
+    if not config.journal:
+        config.journal = f'assignment.shard{config.shard[0] + 1}of{config.shard[1]}.journal' if config.shard else 'assignment.journal'
+
+    if not config.pdf_filename:
+        config.pdf_filename='Exercise§§sheetnr§§.§§username§§.feedback.pdf'
+
+    # Watch mode only previews PDFs
+    if config.watch and (config.mail or config.resume or config.archive or config.shard):
+        raise AToolError('--watch cannot be combined with --mail, --resume, --archive or --shard.')
+    if config.archive and config.no_local_file:
+        raise AToolError('--archive cannot be combined with --no-local-file.')
+    if config.cohort and importlib.util.find_spec('pypdf') is None:
+        raise AToolError("--cohort requires the 'pypdf' package.")
+
+    check_mail_config(config)
+
+    # Check if pdflatex works. This is done last so that configuration errors
+    # are reported without running pdflatex.
+    config.pdflatex_path, config.pdflatex_version = probe_pdflatex(config.pdflatex, None if config.no_cache else config.cache_dir)
+
     return config
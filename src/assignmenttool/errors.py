@@ -20,3 +20,13 @@
 
 class AToolError(RuntimeError):
     pass
+
+class CompileError(AToolError):
+    """A LaTeX document failed to compile. `log` holds the relevant part of
+    the pdflatex log and `timeout` is set if pdflatex was stopped for
+    exceeding its time limit."""
+
+    def __init__(self, message, log = '', timeout = False):
+        super().__init__(message)
+        self.log     = log
+        self.timeout = timeout
@@ -0,0 +1,129 @@
+# Copyright (c) 2020 Leon Kuchenbecker <leon.kuchenbecker@uni-tuebingen.de>
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+
+from collections import namedtuple
+
+import pandas as pd
+
+from assignmenttool.errors import AToolError
+
+Grades = namedtuple('Grades', [ 'tasks', 'comments', 'sheet_comments', 'totals' ])
+
+# Columns identifying a subtask
+TASK_KEYS = [ 'Sheet', 'Task', 'Subtask' ]
+
+def _row(scores, mask):
+    """Returns the first row of `scores` selected by `mask` and its row
+    number in the Excel sheet"""
+    index = mask[mask].index[0]
+    return scores.loc[index], index + 2
+
+def _group_values(rows, keys):
+    """Returns a dict mapping the values of the `keys` columns to the list of
+    values in the 'Value' column, in order of appearance. Equivalent to a
+    groupby with list aggregation, but without creating one object per
+    group."""
+    groups = {}
+    columns = [ rows[key].tolist() for key in keys ]
+    for key, value in zip(columns[0] if len(keys) == 1 else zip(*columns), rows.Value.tolist()):
+        groups.setdefault(key, []).append(value)
+    return groups
+
+def aggregate(scores, sheet_meta):
+    """Validates the rows of the 'Grading' sheet in `scores` and aggregates
+    them per user. Returns a Grades tuple consisting of
+
+     * `tasks`: a frame with one row per scored subtask and the columns
+       'Username', 'Sheet', 'Task', 'Subtask', 'Score' and 'MaxScore', ordered
+       by user (in order of appearance) and subtask
+     * `comments`: a dict mapping (user, sheet, task, subtask) to the list of
+       comments for that subtask
+     * `sheet_comments`: a dict mapping users to their global comments
+     * `totals`: a dict mapping users to their total score
+    """
+    # Check the columns shared by all rows
+    mask = scores.Sheet.isna()
+    if mask.any():
+        _, rownum = _row(scores, mask)
+        raise AToolError(f'Failed to parse provided Excel file, "Grading" sheet contains empty value for "Sheet" column (row {rownum}).')
+    mask = scores.Username.isna()
+    if mask.any():
+        _, rownum = _row(scores, mask)
+        raise AToolError(f'Failed to parse provided Excel file, "Grading" sheet contains empty value for "Username" column (row {rownum}).')
+    types = scores.Type.str.upper()
+    mask  = ~types.isin([ 'SCORE', 'COMMENT' ])
+    if mask.any():
+        row, rownum = _row(scores, mask)
+        raise AToolError(f'Invalid value type "{row.Type}" (row {rownum}).')
+
+    # Scores
+    score_rows = scores[types == 'SCORE']
+    mask = score_rows.Task.isna() | score_rows.Subtask.isna() | score_rows.Value.isna()
+    if mask.any():
+        row, rownum = _row(score_rows, mask)
+        raise AToolError(f'Failed to parse provided Excel file, "Grading" sheet contains empty value for "Task", "Subtask" or "Value" column for sheet {row.Sheet} (row {rownum}).')
+    values = pd.to_numeric(score_rows.Value, errors = 'coerce')
+    mask = values.isna()
+    if mask.any():
+        row, rownum = _row(score_rows, mask)
+        raise AToolError(f'Invalid score "{row.Value}" (User: {row.Username}, Sheet: {row.Sheet}, Task: {row.Task}, Subtask: {row.Subtask}, row {rownum}).')
+    mask = score_rows.duplicated([ 'Username' ] + TASK_KEYS)
+    if mask.any():
+        row, rownum = _row(score_rows, mask)
+        raise AToolError(f'Duplicate score for identical task found (User: {row.Username}, Sheet: {row.Sheet}, Task: {row.Task}, Subtask: {row.Subtask}, row {rownum})')
+
+    # Attach the maximum attainable scores
+    tasks = score_rows[[ 'Username' ] + TASK_KEYS].assign(Score = values).reset_index().merge(
+            sheet_meta.drop_duplicates(TASK_KEYS, keep = 'last')[TASK_KEYS + [ 'MaxScore' ]],
+            on = TASK_KEYS, how = 'left', indicator = True)
+    mask = tasks._merge == 'left_only'
+    if mask.any():
+        row = tasks[mask].iloc[0]
+        raise AToolError(f'Could not find maximum score for task ({row.Sheet}, {row.Task}, {row.Subtask}) (row {row["index"] + 2})')
+
+    # Comments, ignoring empty ones
+    comment_rows = scores[(types == 'COMMENT') & scores.Value.notna()]
+    task_na      = comment_rows.Task.isna()
+    subtask_na   = comment_rows.Subtask.isna()
+    mask = task_na != subtask_na
+    if mask.any():
+        _, rownum = _row(comment_rows, mask)
+        raise AToolError(f'Failed to parse provided Excel file, "Grading" sheet contains empty value for "Task" or "Subtask" but not for both (row {rownum}).')
+    sheet_comments = _group_values(comment_rows[task_na], [ 'Username' ])
+    task_comments  = comment_rows[~task_na]
+    mask = ~task_comments.set_index([ 'Username' ] + TASK_KEYS).index.isin(score_rows.set_index([ 'Username' ] + TASK_KEYS).index)
+    if mask.any():
+        row = task_comments[mask].iloc[0]
+        raise AToolError(f'Comment for task without score found (User: {row.Username}, Sheet: {row.Sheet}, Task: {row.Task}, Subtask: {row.Subtask}, row {task_comments.index[mask][0] + 2})')
+    comments = _group_values(task_comments, [ 'Username' ] + TASK_KEYS)
+
+    # Order users by their first appearance, subtasks numerically
+    users = pd.unique(pd.concat([ score_rows.Username, task_comments.Username ]).sort_index(kind = 'stable'))
+    tasks['Rank'] = tasks.Username.map({ user : rank for rank, user in enumerate(users) })
+    tasks = tasks.sort_values([ 'Rank' ] + TASK_KEYS, kind = 'stable')[[ 'Username' ] + TASK_KEYS + [ 'Score', 'MaxScore' ]].reset_index(drop = True)
+
+    # Total scores, shown as integers if all individual scores are integers
+    by_user  = tasks.groupby('Username', sort = False)
+    sums     = by_user['Score'].sum()
+    integral = (tasks.Score % 1 == 0).groupby(tasks.Username, sort = False).all()
+    totals   = { user : int(total) if integral[user] else float(total) for user, total in sums.items() }
+
+    return Grades(tasks, comments, sheet_comments, totals)
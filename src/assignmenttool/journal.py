@@ -0,0 +1,145 @@
+# Copyright (c) 2020 Leon Kuchenbecker <leon.kuchenbecker@uni-tuebingen.de>
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+
+import hashlib
+import json
+import os
+import threading
+
+from assignmenttool.errors import AToolError
+
+def digest(data):
+    """Returns the SHA-256 hex digest of `data`"""
+    if isinstance(data, str):
+        data = data.encode('utf-8')
+    return hashlib.sha256(data).hexdigest()
+
+def _stamp(path):
+    """Returns the modification time and size of `path`"""
+    try:
+        stat = os.stat(path)
+    except OSError:
+        return None, None
+    return stat.st_mtime, stat.st_size
+
+class Journal:
+    """Append-only on-disk journal of the operations ('compile', 'store' and
+    'mail') completed per sheet and user. Every record is flushed to disk
+    before the operation is considered complete, so that an interrupted run
+    can be resumed without repeating completed operations. The 'compile'
+    records hold the digest of the compiled LaTeX document, so that documents
+    that changed since can be detected."""
+
+    def __init__(self, path, infile, resume = False):
+        self.path    = path
+        self.records = {}
+        self.lock    = threading.Lock()
+        infile       = os.path.abspath(infile)
+
+        if resume and os.path.exists(path):
+            try:
+                with open(path, 'r') as jfile:
+                    raw = [ line for line in jfile if line.strip() ]
+            except OSError as e:
+                raise AToolError(f"Cannot read journal '{path}': {e}")
+            lines = []
+            for num, line in enumerate(raw):
+                try:
+                    lines.append(json.loads(line))
+                except ValueError:
+                    if num != len(raw) - 1:
+                        raise AToolError(f"Cannot read journal '{path}': line {num + 1} is corrupt.")
+                    # Drop a truncated last record left behind by a crash
+                    with open(path + '.tmp', 'w') as jfile:
+                        jfile.writelines(raw[:-1])
+                        jfile.flush()
+                        os.fsync(jfile.fileno())
+                    os.replace(path + '.tmp', path)
+            if lines and lines[0].get('infile') != infile:
+                raise AToolError(f"Journal '{path}' belongs to a run on '{lines[0].get('infile')}', cannot resume.")
+            if lines and [ lines[0].get('mtime'), lines[0].get('size') ] != list(_stamp(infile)):
+                print(f"[WARN]\t'{infile}' was modified since the run recorded in '{path}'.")
+            for record in lines[1:]:
+                self.records[(record['sheet'], record['user'], record['op'])] = record
+            self.file = self._open('a')
+        else:
+            # A new journal replaces the old one only once the first operation
+            # completes, so that a run failing right away keeps it intact
+            self.file = None
+        self.infile = infile
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def close(self):
+        if self.file:
+            self.file.close()
+
+    def _open(self, mode):
+        try:
+            return open(self.path, mode)
+        except OSError as e:
+            raise AToolError(f"Cannot open journal '{self.path}': {e}")
+
+    def _write(self, record):
+        if self.file is None:
+            self.file = self._open('w')
+            mtime, size = _stamp(self.infile)
+            self._write({ 'infile' : self.infile, 'mtime' : mtime, 'size' : size })
+        self.file.write(json.dumps(record) + '\n')
+        self.file.flush()
+        os.fsync(self.file.fileno())
+
+    def record(self, sheet, user, op, **kwargs):
+        """Records the completion of operation `op` for `user` on `sheet`"""
+        record = dict(sheet = int(sheet), user = user, op = op, **kwargs)
+        with self.lock:
+            self._write(record)
+            self.records[(record['sheet'], user, op)] = record
+
+    def done(self, sheet, user, op):
+        """Checks whether operation `op` was completed for `user` on `sheet`"""
+        return (int(sheet), user, op) in self.records
+
+    def outdated(self, sheet, user, tex):
+        """Checks whether the PDF of `user` on `sheet` was stored or mailed
+        by a previous run, but compiled from a LaTeX document other than
+        `tex`, e.g. because the grades changed since"""
+        record = self.records.get((int(sheet), user, 'compile'))
+        if record is None or record.get('sha256') == digest(tex):
+            return False
+        return self.done(sheet, user, 'store') or self.done(sheet, user, 'mail')
+
+    def stored_pdf(self, sheet, user, path):
+        """Returns the PDF previously stored at `path` for `user` on `sheet`
+        if it is still unchanged, None otherwise"""
+        record = self.records.get((int(sheet), user, 'store'))
+        if record is None:
+            return None
+        try:
+            with open(path, 'rb') as infile:
+                pdf = infile.read()
+        except OSError:
+            return None
+        return pdf if digest(pdf) == record.get('sha256') else None
@@ -0,0 +1,460 @@
+# Copyright (c) 2020 Leon Kuchenbecker <leon.kuchenbecker@uni-tuebingen.de>
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+
+import hashlib
+import io
+import json
+import os
+import re
+import shutil
+import signal
+import subprocess
+import tempfile
+import threading
+import time
+
+from assignmenttool.errors import AToolError, CompileError
+from assignmenttool.stats import collector
+
+# Upper bound for the number of pdflatex passes per document
+MAX_PASSES = 3
+
+# Log messages indicating that another pass is required
+_RERUN_PATTERN = re.compile(r'Rerun to get|Please rerun LaTeX|Rerun LaTeX|Label\(s\) may have changed|There were undefined (references|citations)')
+
+# Lines written to every .aux file that do not require another pass
+_TRIVIAL_AUX_PATTERN = re.compile(r'^(\\relax|\\gdef\s*\\@abspage@last\{\d+\})$')
+
+# Maximum number of pdflatex log lines reported for a failed document
+LOG_EXCERPT_LINES = 20
+
+# Number of preamble formats kept in the cache. Every format takes several
+# megabytes and every edit of a template preamble creates a new one.
+MAX_FORMATS = 4
+
+class CompileStats:
+    """Thread safe counters for the LaTeX compilations of a run"""
+
+    def __init__(self):
+        self.lock      = threading.Lock()
+        self.documents = 0
+        self.passes    = 0
+        self.cached    = 0
+
+    def record(self, passes, documents = 1):
+        with self.lock:
+            self.documents += documents
+            self.passes    += passes
+            if not passes:
+                self.cached += 1
+
+    def __str__(self):
+        return f'{self.documents} documents, {self.passes} LaTeX passes, {self.cached} from cache'
+
+def _read_text(path):
+    try:
+        with open(path, 'r', encoding = 'latin-1') as infile:
+            return infile.read()
+    except OSError:
+        return None
+
+def _log_excerpt(tdir):
+    """Returns the error messages of the pdflatex log in `tdir` with some
+    context, or the end of the log if it contains no error messages"""
+    log = (_read_text(os.path.join(tdir, 'out.log')) or '').splitlines()
+    excerpt = []
+    for num, line in enumerate(log):
+        if line.startswith('!'):
+            excerpt += log[num:num + 3]
+    if not excerpt:
+        excerpt = log[-LOG_EXCERPT_LINES:]
+    return '\n'.join(excerpt[:LOG_EXCERPT_LINES])
+
+def _needs_rerun(tdir, prev_aux):
+    """Decides whether another pdflatex pass is required. Returns the decision
+    and the current content of the .aux file"""
+    aux = _read_text(os.path.join(tdir, 'out.aux')) or ''
+    log = _read_text(os.path.join(tdir, 'out.log')) or ''
+    if _RERUN_PATTERN.search(log):
+        return True, aux
+    if prev_aux is None:
+        # After the first pass, any non-trivial .aux content is read back by
+        # the next pass
+        return any(line.strip() and not _TRIVIAL_AUX_PATTERN.match(line.strip()) for line in aux.splitlines()), aux
+    return aux != prev_aux, aux
+
+def probe_pdflatex(pdflatex, cache_dir = None):
+    """Checks that `pdflatex` can be executed and returns its resolved path
+    and version string. If a cache directory is provided, the version of a
+    binary is only queried again if its modification time or size changed."""
+    path = shutil.which(pdflatex)
+    if path is None:
+        raise AToolError(f"Failed to execute pdflatex ({pdflatex}). Please specify the path to the pdflatex binary using --pdflatex")
+    try:
+        stat = os.stat(path)
+        stamp = [ stat.st_mtime_ns, stat.st_size ]
+    except OSError:
+        stamp = None
+
+    probes = {}
+    probe_file = os.path.join(cache_dir, 'pdflatex.json') if cache_dir and stamp else None
+    if probe_file:
+        try:
+            with open(probe_file, 'r') as infile:
+                probes = json.load(infile)
+            entry = probes[path]
+            if entry['stamp'] == stamp:
+                return path, entry['version']
+        except (OSError, ValueError, KeyError, TypeError):
+            pass
+
+    ret = _pdflatex([path, '--version'], None)
+    if ret.returncode != 0:
+        raise AToolError(f"Failed to execute pdflatex ({pdflatex}). Please specify the path to the pdflatex binary using --pdflatex")
+    version = ret.stdout.decode('utf-8', 'replace').strip()
+
+    if probe_file:
+        if not isinstance(probes, dict):
+            probes = {}
+        probes[path] = { 'stamp' : stamp, 'version' : version }
+        try:
+            os.makedirs(cache_dir, exist_ok = True)
+            fd, tmppath = tempfile.mkstemp(dir = cache_dir, suffix = '.tmp')
+            with os.fdopen(fd, 'w') as outfile:
+                json.dump(probes, outfile)
+            os.replace(tmppath, probe_file)
+        except OSError:
+            # A failing cache must never fail the run
+            pass
+    return path, version
+
+class LaTeXFormat:
+    """A pdflatex format file containing the precompiled preamble of a
+    template"""
+
+    def __init__(self, directory, name, preamble):
+        self.directory = directory
+        self.name      = name
+        self.preamble  = preamble
+
+    def matches(self, tex):
+        """Checks whether the document `tex` can be compiled using this format"""
+        return tex.startswith(self.preamble)
+
+def _split_preamble(template):
+    """Returns the preamble of `template`, i.e. everything before
+    \\begin{document}, or None if there is no such preamble"""
+    pos = template.find('\\begin{document}')
+    if pos <= 0:
+        return None
+    return template[:pos]
+
+def build_format(template, pdflatex, pdflatex_version, directory, timeout = None, build_dir = None, group = None):
+    """Dumps the preamble of `template` into a pdflatex format file in
+    `directory`, reusing an existing format for an identical preamble and
+    pdflatex version. Returns None if no format can be created."""
+    preamble = _split_preamble(template)
+    if preamble is None or '§§' in preamble:
+        # Preambles containing variables differ between documents
+        return None
+
+    digest = hashlib.sha256(f'{pdflatex}\0{pdflatex_version}\0{preamble}'.encode('utf-8')).hexdigest()
+    name   = 'assignmenttool-' + digest[:16]
+    fmt    = LaTeXFormat(directory, name, preamble)
+    try:
+        # Mark the format as recently used
+        os.utime(os.path.join(directory, name + '.fmt'))
+        return fmt
+    except OSError:
+        pass
+
+    tdir = tempfile.mkdtemp(dir = build_dir)
+    try:
+        with open(os.path.join(tdir, 'preamble.tex'), 'w') as out:
+            out.write(preamble + '\n\\dump\n')
+        ret = _pdflatex([pdflatex, '-ini', '--interaction', 'batchmode', '-jobname=' + name, '&pdflatex', 'preamble.tex'], tdir, timeout = timeout, group = group)
+        if ret.returncode != 0 or not os.path.exists(os.path.join(tdir, name + '.fmt')):
+            return None
+        os.makedirs(directory, exist_ok = True)
+        os.replace(os.path.join(tdir, name + '.fmt'), os.path.join(directory, name + '.fmt'))
+    except (OSError, CompileError):
+        return None
+    finally:
+        shutil.rmtree(tdir, ignore_errors = True)
+    _prune_formats(directory)
+    return fmt
+
+def _prune_formats(directory):
+    """Removes all but the MAX_FORMATS most recently used formats from
+    `directory`"""
+    formats = []
+    try:
+        for entry in os.scandir(directory):
+            if entry.name.startswith('assignmenttool-') and entry.name.endswith('.fmt'):
+                try:
+                    formats.append((entry.stat().st_mtime, entry.path))
+                except OSError:
+                    pass
+    except OSError:
+        return
+    for _, path in sorted(formats, reverse = True)[MAX_FORMATS:]:
+        try:
+            os.remove(path)
+        except OSError:
+            pass
+
+def _kill(pid):
+    """Kills the pdflatex process `pid` and all processes started by it"""
+    try:
+        os.killpg(pid, signal.SIGKILL)
+    except (AttributeError, OSError):
+        try:
+            os.kill(pid, signal.SIGKILL)
+        except OSError:
+            pass
+
+class CompileGroup:
+    """The running pdflatex processes of a run. pdflatex runs in a session of
+    its own, so that timeouts can kill all processes started by it, and
+    therefore does not receive the Ctrl-C of the terminal. cancel() kills
+    all running processes of the group and fails all further compilations
+    of the group, including retries."""
+
+    def __init__(self):
+        self.running   = set()
+        self.lock      = threading.Lock()
+        self.cancelled = threading.Event()
+
+    def cancel(self):
+        self.cancelled.set()
+        with self.lock:
+            running = list(self.running)
+        for pid in running:
+            _kill(pid)
+
+    def check(self):
+        """Raises a CompileError if the group was cancelled"""
+        if self.cancelled.is_set():
+            raise CompileError('The compilation was cancelled')
+
+    def add(self, pid):
+        with self.lock:
+            self.running.add(pid)
+        # The group may have been cancelled while starting pdflatex
+        if self.cancelled.is_set():
+            _kill(pid)
+
+    def discard(self, pid):
+        with self.lock:
+            self.running.discard(pid)
+
+def _pdflatex(cmd, tdir, env = None, timeout = None, group = None):
+    """Runs a single pdflatex process in `tdir`. If it does not finish
+    within `timeout` seconds, pdflatex and all processes started by it are
+    killed and a CompileError is raised. The process is registered with
+    `group`, if given, so that it can be cancelled."""
+    if group:
+        group.check()
+    collector.count('subprocesses')
+    with subprocess.Popen(cmd, cwd = tdir, env = env, stdout = subprocess.PIPE, stderr = subprocess.PIPE, start_new_session = True) as proc:
+        if group:
+            group.add(proc.pid)
+        try:
+            stdout, stderr = proc.communicate(timeout = timeout)
+        except subprocess.TimeoutExpired:
+            _kill(proc.pid)
+            proc.communicate()
+            collector.count('compile_timeouts')
+            raise CompileError(f'pdflatex did not finish within {timeout:g} seconds', _log_excerpt(tdir), timeout = True)
+        except:
+            # E.g. Ctrl-C while waiting for pdflatex
+            _kill(proc.pid)
+            raise
+        finally:
+            if group:
+                group.discard(proc.pid)
+    if group:
+        group.check()
+    return subprocess.CompletedProcess(cmd, proc.returncode, stdout, stderr)
+
+def _run_passes(cmd, tdir, env = None, timeout = None, group = None):
+    """Runs pdflatex until the document is complete and returns the number
+    of passes or None if pdflatex failed"""
+    aux = None
+    for passes in range(1, MAX_PASSES + 1):
+        ret = _pdflatex(cmd, tdir, env, timeout, group)
+        if ret.returncode != 0:
+            return None
+        rerun, aux = _needs_rerun(tdir, aux)
+        if not rerun:
+            break
+    return passes
+
+def _compile_in(tdir, tex, pdflatex, fmt, timeout, keepdir, group):
+    """Compiles the LaTeX document `tex` to out.pdf in `tdir`, against the
+    format `fmt` if it matches, and returns the number of passes"""
+    passes = None
+    if fmt and fmt.matches(tex):
+        with open(os.path.join(tdir, 'out.tex'), 'w') as out:
+            out.write(tex[len(fmt.preamble):])
+        env = dict(os.environ, TEXFORMATS = fmt.directory + os.pathsep)
+        passes = _run_passes([pdflatex, '-fmt=' + fmt.name, '--interaction', 'batchmode', 'out'], tdir, env, timeout, group)
+    if passes is None:
+        # Compile the full document, also if compiling against the format failed
+        with open(os.path.join(tdir, 'out.tex'), 'w') as out:
+            out.write(tex)
+        passes = _run_passes([pdflatex, '--interaction', 'batchmode', 'out'], tdir, None, timeout, group)
+        if passes is None:
+            raise CompileError('An error occurred during LaTeX execution' + (f" in '{tdir}'" if keepdir else ''), _log_excerpt(tdir))
+    return passes
+
+def _with_retries(run, retries, group):
+    """Calls `run` and calls it again up to `retries` times if pdflatex timed
+    out, unless `group` was cancelled"""
+    for attempt in range(retries + 1):
+        try:
+            return run()
+        except CompileError as e:
+            if not e.timeout or attempt == retries or (group and group.cancelled.is_set()):
+                raise
+            collector.count('compile_retries')
+
+def compileLaTeX(tex, pdflatex, keepdir = False, cache = None, stats = None, fmt = None, timeout = None, retries = 0, build_dir = None, group = None):
+    """Compiles the LaTeX document `tex` and returns the build directory (if
+    `keepdir` is set) and the resulting PDF. If a cache is provided, a
+    previously compiled PDF of an identical document is reused. If a format
+    is provided and matches the document, the document body is compiled
+    against the precompiled preamble. Additional pdflatex passes are only run
+    if the document requires them. Every pdflatex run is limited to
+    `timeout` seconds and the compilation is retried up to `retries` times if
+    it timed out. Build directories are created in `build_dir` and removed
+    unless `keepdir` is set. pdflatex processes are registered with the
+    CompileGroup `group`, if given. Raises a CompileError if the document
+    cannot be compiled."""
+    start = time.perf_counter()
+    try:
+        return _with_retries(lambda : _compileLaTeX(tex, pdflatex, keepdir, cache, stats, fmt, timeout, build_dir, group), retries, group)
+    finally:
+        collector.latency('compile', time.perf_counter() - start)
+
+def _compileLaTeX(tex, pdflatex, keepdir, cache, stats, fmt, timeout, build_dir, group):
+    if cache:
+        key = cache.key(tex)
+        pdf = cache.get(key)
+        if pdf is not None:
+            if stats:
+                stats.record(0)
+            return None, pdf
+    tdir = tempfile.mkdtemp(dir = build_dir)
+    try:
+        passes = _compile_in(tdir, tex, pdflatex, fmt, timeout, keepdir, group)
+        with open(os.path.join(tdir, 'out.pdf'), 'rb') as infile:
+            pdf = infile.read()
+    finally:
+        if not keepdir:
+            shutil.rmtree(tdir, ignore_errors = True)
+    if stats:
+        stats.record(passes)
+    if cache:
+        cache.put(key, pdf)
+    return tdir if keepdir else None, pdf
+
+def _split_body(tex):
+    """Returns the part of `tex` between \\begin{document} and \\end{document}"""
+    start = tex.find('\\begin{document}') + len('\\begin{document}')
+    end   = tex.rfind('\\end{document}')
+    return tex[start:end]
+
+def compile_cohort(texs, pdflatex, keepdir = False, cache = None, stats = None, fmt = None, timeout = None, retries = 0, build_dir = None, group = None):
+    """Compiles the LaTeX documents `texs`, which must share the same
+    preamble, as a single document and splits the resulting PDF into one PDF
+    per input document. Returns a list of (build directory, PDF) tuples in
+    the order of `texs`. Timeouts, retries, build directories and the
+    CompileGroup are handled as by compileLaTeX(). Raises a CompileError if the documents cannot be
+    compiled at once."""
+    try:
+        from pypdf import PdfReader, PdfWriter
+    except ImportError:
+        raise AToolError("Compiling all documents at once requires the 'pypdf' package.")
+
+    results = [ None ] * len(texs)
+
+    # Documents found in the cache do not need to be compiled again
+    todo = []
+    for idx, tex in enumerate(texs):
+        pdf = cache.get(cache.key(tex)) if cache else None
+        if pdf is not None:
+            results[idx] = (None, pdf)
+            if stats:
+                stats.record(0)
+        else:
+            todo.append(idx)
+    if not todo:
+        return results
+
+    preamble = _split_preamble(texs[todo[0]])
+    if preamble is None or any(not texs[idx].startswith(preamble) for idx in todo):
+        raise CompileError('Cannot compile all documents at once, the LaTeX template must have a preamble without variables.')
+
+    # Record the number of pages shipped out before every document
+    doc = [ preamble, '\\begin{document}',
+            '\\newwrite\\atoolpages\\immediate\\openout\\atoolpages=\\jobname.pages',
+            '\\newcommand\\atoolnext{\\clearpage\\immediate\\write\\atoolpages{\\the\\ReadonlyShipoutCounter}\\setcounter{page}{1}}' ]
+    for idx in todo:
+        doc += [ '\\atoolnext', '\\begingroup', _split_body(texs[idx]), '\\endgroup' ]
+    doc += [ '\\atoolnext', '\\immediate\\closeout\\atoolpages', '\\end{document}', '' ]
+    doc = '\n'.join(doc)
+
+    def run():
+        tdir = tempfile.mkdtemp(dir = build_dir)
+        try:
+            passes = _compile_in(tdir, doc, pdflatex, fmt, timeout, keepdir, group)
+            with open(os.path.join(tdir, 'out.pdf'), 'rb') as infile:
+                pdf = infile.read()
+            try:
+                with open(os.path.join(tdir, 'out.pages'), 'r') as infile:
+                    bounds = [ int(line) for line in infile if line.strip() ]
+            except (OSError, ValueError):
+                bounds = []
+        finally:
+            if not keepdir:
+                shutil.rmtree(tdir, ignore_errors = True)
+        return tdir, passes, pdf, bounds
+    tdir, passes, pdf, bounds = _with_retries(run, retries, group)
+    if stats:
+        stats.record(passes, len(todo))
+
+    # Split the PDF along the recorded page boundaries
+    reader = PdfReader(io.BytesIO(pdf))
+    if len(bounds) != len(todo) + 1 or bounds[-1] != len(reader.pages):
+        raise CompileError('Failed to determine the page ranges of the individual documents' + (f" in '{tdir}'" if keepdir else ''))
+    for pos, idx in enumerate(todo):
+        writer = PdfWriter()
+        for page in range(bounds[pos], bounds[pos + 1]):
+            writer.add_page(reader.pages[page])
+        buf = io.BytesIO()
+        writer.write(buf)
+        pdf = buf.getvalue()
+        if cache:
+            cache.put(cache.key(texs[idx]), pdf)
+        results[idx] = (tdir if keepdir else None, pdf)
+
+    return results
@@ -0,0 +1,245 @@
+# Copyright (c) 2020 Leon Kuchenbecker <leon.kuchenbecker@uni-tuebingen.de>
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+
+import csv
+import getpass
+import io
+import os
+import tempfile
+import time
+import zipfile
+
+from collections import deque
+
+from assignmenttool import SMTPClient
+from assignmenttool.errors import AToolError
+from assignmenttool.template import Template
+
+# Variables available in the mail subject and body
+MAIL_VARIABLES = [ 'username', 'name', 'sheetnr', 'tutorname' ]
+
+# Archives of the BCC digest larger than this are stored locally instead of
+# being attached
+DIGEST_MAX_ATTACHMENT = 20 * 1024 * 1024
+
+class DigestArchive:
+    """Collects the sent feedback PDFs in a temporary ZIP archive together
+    with a delivery report, to be sent to the BCC recipients at once"""
+
+    def __init__(self):
+        self.file    = tempfile.TemporaryFile()
+        self.zip     = zipfile.ZipFile(self.file, 'w', zipfile.ZIP_STORED)
+        self.entries = []
+
+    def add(self, filename, pdf):
+        self.zip.writestr(filename, pdf)
+
+    def record(self, user, sheet, name, email, status):
+        self.entries.append((user, sheet, name, email, status))
+
+    def report(self):
+        """Returns the delivery report as CSV"""
+        out = io.StringIO()
+        writer = csv.writer(out)
+        writer.writerow([ 'Username', 'Sheet', 'Name', 'E-Mail', 'Status' ])
+        writer.writerows(self.entries)
+        return out.getvalue()
+
+    def finish(self):
+        """Adds the delivery report and returns the archive data"""
+        self.zip.writestr('report.csv', self.report())
+        self.zip.close()
+        self.file.seek(0)
+        return self.file.read()
+
+    def close(self):
+        self.file.close()
+
+class FeedbackMailer:
+    """Sends feedback PDFs to the participants while they are being produced.
+    Results are reported in submission order and successfully sent messages
+    are recorded in `journal`, if given. Failed messages are reported and do
+    not affect the remaining messages, unless the failure affects all
+    messages, e.g. a failed login, which aborts sending."""
+
+    def __init__(self, config, participants, journal = None):
+        self.config       = config
+        self.participants = participants
+        self.journal      = journal
+        self.pending      = deque()
+        self.failed       = []
+        self.total        = 0
+        self.subject      = Template(config.mail_subject, MAIL_VARIABLES, 'mail subject')
+        self.body         = Template(config.mail_template_text, MAIL_VARIABLES, f"mail template '{config.mail_template}'")
+        self.digest       = DigestArchive() if config.mail_bcc_digest else None
+
+        if config.mail_smtp_user and not config.mail_smtp_pass:
+            config.mail_smtp_pass = getpass.getpass(f'Password for [{config.mail_smtp_user}@{config.mail_smtp_host}]: ')
+
+        self.pool = SMTPClient.SMTPPool(
+                size = config.mail_connections,
+                rate = config.mail_rate,
+                backlog = 4 * config.mail_connections,
+                hostname = config.mail_smtp_host,
+                port = config.mail_smtp_port,
+                user = config.mail_smtp_user,
+                password = config.mail_smtp_pass,
+                tls = not config.mail_smtp_no_tls,
+                max_messages = config.mail_max_messages)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, *args):
+        interrupted = exc_type is KeyboardInterrupt
+        try:
+            try:
+                if interrupted:
+                    self.pool.cancel()
+            finally:
+                # Wait for the mails being sent and record them also if the
+                # run failed, so that they are not sent again on --resume
+                self.report(wait = True)
+            # Send the digest also if the run failed, as it documents the
+            # mails that were sent
+            if self.digest and not interrupted and self.pool.error is None:
+                self.send_digest()
+        finally:
+            self.pool.close()
+            if self.digest:
+                self.digest.close()
+        if exc_type is None:
+            self.finish()
+
+    def send(self, user, sheet, filename, pdf):
+        """Queues the feedback PDF `pdf` for `user` on sheet `sheet`. Blocks if
+        too many messages are already waiting to be sent."""
+        config = self.config
+        self.total += 1
+
+        # Lookup recipient name and email address
+        try:
+            name = self.participants.loc[user]['Name']
+            email = self.participants.loc[user]['E-Mail']
+        except KeyError:
+            print(f'[FAILED]\t{user}: Failed to look up name and email address.')
+            self.failed.append(user)
+            if self.digest:
+                self.digest.record(user, sheet, None, None, 'failed: unknown participant')
+            return
+
+        variables = { 'username' : user, 'name' : name, 'sheetnr' : sheet, 'tutorname' : config.tutor_name }
+        future = self.pool.submit(
+                sender       = (config.mail_sender_name, config.mail_sender_address),
+                recipients   = (name, email),
+                subject      = self.subject.render(variables),
+                message_text = self.body.render(variables),
+                attachments  = {
+                    filename : pdf
+                    },
+                bcc = None if self.digest else config.mail_bcc
+                )
+        if self.digest:
+            self.digest.add(filename, pdf)
+        self.pending.append((user, sheet, name, email, future))
+        self.report()
+
+    def report(self, wait = False):
+        """Reports the results of sent messages in submission order. Unless
+        `wait` is set, stops at the first message still being sent."""
+        while self.pending and (wait or self.pending[0][4].done()):
+            user, sheet, name, email, future = self.pending.popleft()
+            if future.cancelled():
+                print(f'[SKIP]\t{user} -> {name} <{email}>: Not sent')
+                if self.digest:
+                    self.digest.record(user, sheet, name, email, 'not sent')
+                continue
+            try:
+                future.result()
+            except Exception as e:
+                print(f'[FAILED]\t{user} -> {name} <{email}>: {e}')
+                self.failed.append(user)
+                if self.digest:
+                    self.digest.record(user, sheet, name, email, f'failed: {e}')
+            else:
+                if self.journal:
+                    self.journal.record(sheet, user, 'mail')
+                if self.digest:
+                    self.digest.record(user, sheet, name, email, 'sent')
+                print(f'[OK]\t{user} -> {name} <{email}>')
+
+    def send_digest(self):
+        """Sends a single mail with an archive of all sent PDFs and the
+        delivery report to the BCC recipients. Archives too large to be
+        attached are stored locally and referred to instead."""
+        config  = self.config
+        bcc     = config.mail_bcc if isinstance(config.mail_bcc, list) else [ config.mail_bcc ]
+        entries = self.digest.entries
+        if not entries:
+            return
+        sent    = sum(1 for entry in entries if entry[4] == 'sent')
+        archive = self.digest.finish()
+        name    = time.strftime('feedback-digest-%Y%m%d-%H%M%S.zip')
+
+        text = [ f'Feedback was sent to {sent} of {len(entries)} participants.', '' ]
+        attachments = {}
+        if len(archive) > DIGEST_MAX_ATTACHMENT:
+            try:
+                with open(name, 'wb') as outfile:
+                    outfile.write(archive)
+            except OSError as e:
+                print(f"[FAILED]\tDigest: Cannot store archive '{name}': {e}")
+                self.failed.append('digest')
+                return
+            text += [ f'The PDFs are too large to be attached and were archived at {os.path.abspath(name)}', '' ]
+            attachments['report.csv'] = self.digest.report().encode('utf-8')
+        else:
+            attachments[name] = archive
+        text += [ f'{user} [sheet {sheet}] -> {name_} <{email}>: {status}' for user, sheet, name_, email, status in entries ]
+
+        try:
+            self.pool.submit(
+                    sender       = (config.mail_sender_name, config.mail_sender_address),
+                    recipients   = [ (None, address) for address in bcc ],
+                    subject      = f'Feedback digest: {sent} of {len(entries)} mails sent',
+                    message_text = '\n'.join(text),
+                    attachments  = attachments,
+                    ).result()
+        except Exception as e:
+            print(f'[FAILED]\tDigest -> {", ".join(bcc)}: {e}')
+            self.failed.append('digest')
+        else:
+            print(f'[OK]\tDigest -> {", ".join(bcc)}')
+
+    def finish(self):
+        """Waits for all messages and raises an error if any of them failed"""
+        self.report(wait = True)
+        self.pool.check()
+        if self.failed:
+            raise AToolError(f'Failed to send feedback to {len(self.failed)} of {self.total} participants: {", ".join(self.failed)}')
+
+def mail_feedback(config, participants, pdfs):
+    """Send the feedback PDFs to the participants. `pdfs` maps users to dicts
+    with the keys 'sheet', 'filename' and 'data'. Failed messages are
+    reported and do not affect the remaining messages."""
+    with FeedbackMailer(config, participants) as mailer:
+        for user, pdf in pdfs.items():
+            mailer.send(user, pdf['sheet'], pdf['filename'], pdf['data'])
@@ -0,0 +1,118 @@
+# Copyright (c) 2020 Leon Kuchenbecker <leon.kuchenbecker@uni-tuebingen.de>
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+import hashlib
+import os
+import tempfile
+import threading
+
+from assignmenttool.errors import AToolError
+
+# When the cache exceeds its limit, it is shrunk to this fraction of the limit
+# so that it does not have to be scanned again on every insertion
+EVICT_TARGET = 0.8
+
+def default_cache_dir():
+    """Returns the default cache directory, honouring $XDG_CACHE_HOME"""
+    base = os.environ.get('XDG_CACHE_HOME') or os.path.join(os.path.expanduser('~'), '.cache')
+    return os.path.join(base, 'assignmenttool')
+
+class PDFCache:
+    """On-disk cache for compiled PDFs. Entries are keyed on the hash of the
+    rendered LaTeX source and the pdflatex binary and version used to compile
+    it. Once the cache exceeds `max_size` bytes, the least recently used
+    entries are evicted. The size of the cache is determined by a single scan
+    and then tracked as entries are added."""
+
+    def __init__(self, path, max_size, pdflatex, pdflatex_version):
+        self.path     = path
+        self.max_size = max_size
+        self.salt     = f'{pdflatex}\0{pdflatex_version}\0'.encode('utf-8')
+        self.lock     = threading.Lock()
+        self.size     = None
+        try:
+            os.makedirs(self.path, exist_ok = True)
+        except OSError as e:
+            raise AToolError(f"Cannot create cache directory '{self.path}': {e}")
+
+    def key(self, tex):
+        """Computes the cache key for a rendered LaTeX document"""
+        return hashlib.sha256(self.salt + tex.encode('utf-8')).hexdigest()
+
+    def _entry(self, key):
+        return os.path.join(self.path, key + '.pdf')
+
+    def get(self, key):
+        """Returns the cached PDF for `key` or None if there is none"""
+        entry = self._entry(key)
+        try:
+            with open(entry, 'rb') as infile:
+                pdf = infile.read()
+        except OSError:
+            return None
+        # Mark the entry as recently used
+        try:
+            os.utime(entry)
+        except OSError:
+            pass
+        return pdf
+
+    def put(self, key, pdf):
+        """Stores the PDF for `key` in the cache and evicts old entries if
+        necessary"""
+        try:
+            fd, tmppath = tempfile.mkstemp(dir = self.path, suffix = '.tmp')
+            with os.fdopen(fd, 'wb') as outfile:
+                outfile.write(pdf)
+            os.replace(tmppath, self._entry(key))
+        except OSError:
+            # A failing cache must never fail the run
+            return
+        with self.lock:
+            if self.size is not None:
+                self.size += len(pdf)
+            full = self.size is None or self.size > self.max_size
+        if full:
+            self.evict()
+
+    def evict(self):
+        """Removes the least recently used entries if the cache exceeds its
+        limit and updates the tracked cache size"""
+        with self.lock:
+            entries = []
+            for entry in os.scandir(self.path):
+                if not entry.name.endswith('.pdf'):
+                    continue
+                try:
+                    stat = entry.stat()
+                except OSError:
+                    continue
+                entries.append((stat.st_mtime, stat.st_size, entry.path))
+            total = sum(size for _, size, _ in entries)
+            if total > self.max_size:
+                for _, size, path in sorted(entries):
+                    if total <= EVICT_TARGET * self.max_size:
+                        break
+                    try:
+                        os.remove(path)
+                    except OSError:
+                        pass
+                    total -= size
+            self.size = total
@@ -0,0 +1,94 @@
+# Copyright (c) 2020 Leon Kuchenbecker <leon.kuchenbecker@uni-tuebingen.de>
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+
+import contextlib
+import hashlib
+import os
+
+from assignmenttool.archive import Archive, read_archive
+from assignmenttool.errors import AToolError
+from assignmenttool.journal import Journal
+
+def shard_of(user, count):
+    """Returns the zero-based shard of `user` among `count` shards. The
+    assignment only depends on the username, so that it is the same on every
+    machine and in every run."""
+    return int.from_bytes(hashlib.sha256(str(user).encode('utf-8')).digest()[:8], 'big') % count
+
+def select_shard(scores, index, count):
+    """Returns the rows of `scores` belonging to the users of shard `index`.
+    Rows without a username are kept in the first shard only, so that they
+    are still reported."""
+    users = scores.Username.dropna().unique()
+    mine  = [ user for user in users if shard_of(user, count) == index ]
+    print(f'Shard {index + 1}/{count}: {len(mine)} of {len(users)} participants')
+    return scores[scores.Username.isin(mine) | (scores.Username.isna() & (index == 0))]
+
+def merge(config):
+    """Combines the archives written by several shards into a single archive
+    and optionally mails the PDFs to the participants. If the Excel file is
+    given, participants graded on the merged sheets but missing from all
+    shards are reported. Sent mails are recorded in the journal, so that an
+    interrupted merge can be resumed without sending any mail twice."""
+    workbook = participants = None
+    if config.workbook:
+        from assignmenttool.workbook import load_workbook
+        workbook     = load_workbook(config.workbook)
+        participants = workbook.participants.set_index('Username')
+    if config.mail:
+        from assignmenttool.mailer import FeedbackMailer
+
+    merged = set()
+    names  = set()
+    with Journal(config.journal, config.workbook or config.output, config.resume) as journal, \
+            Archive(config.output) as output, \
+            FeedbackMailer(config, participants, journal) if config.mail else contextlib.nullcontext() as mailer:
+        for path in config.inputs:
+            count = 0
+            for entry, pdf in read_archive(path):
+                if entry['File'] in names or (entry['File'] in output and not config.resume):
+                    raise AToolError(f"'{entry['File']}' from '{path}' is already contained in '{config.output}'. Do the shards overlap?")
+                names.add(entry['File'])
+
+                # PDFs merged by the resumed run must not have changed since
+                if entry['File'] in output:
+                    if output.sha256(entry['File']) != entry['SHA256']:
+                        raise AToolError(f"'{entry['File']}' from '{path}' differs from the one merged into '{config.output}' before, cannot resume.")
+                else:
+                    output.add(entry['File'], pdf, entry['Username'], entry['Sheet'], entry['Score'], entry['MaxScore'], entry['SHA256'])
+                merged.add((entry['Username'], int(entry['Sheet'])))
+                if mailer and not journal.done(entry['Sheet'], entry['Username'], 'mail'):
+                    mailer.send(entry['Username'], int(entry['Sheet']), os.path.basename(entry['File']), pdf)
+                count += 1
+            print(f"[OK]\t{path}: {count} PDFs")
+
+    print(f"Merged {len(merged)} PDFs from {len(config.inputs)} archives into '{config.output}'")
+
+    # Check that the shards together cover all graded participants
+    if workbook is not None:
+        scores  = workbook.grading
+        scores  = scores[scores.Sheet.isin({ sheet for _, sheet in merged }) & (scores.Type.str.upper() == 'SCORE')]
+        missing = sorted({ (user, int(sheet)) for user, sheet in zip(scores.Username, scores.Sheet) } - merged)
+        for user, sheet in missing:
+            print(f'[WARN]\t{user} [sheet {sheet}] is missing from all shards')
+        if missing:
+            raise AToolError(f'{len(missing)} PDFs are missing from the shards.')
+    return 0
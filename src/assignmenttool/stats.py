@@ -0,0 +1,109 @@
+# Copyright (c) 2020 Leon Kuchenbecker <leon.kuchenbecker@uni-tuebingen.de>
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+
+import contextlib
+import json
+import math
+import threading
+import time
+
+from collections import defaultdict
+
+def percentile(values, pct):
+    """Returns the `pct`-th percentile of the sorted list `values` using the
+    nearest-rank method"""
+    if not values:
+        return None
+    return values[max(0, math.ceil(pct / 100 * len(values)) - 1)]
+
+class RunStats:
+    """Thread safe collector of phase wall times, counters and per-item
+    latencies of a run"""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        with self.lock:
+            self.phases    = {}
+            self.counters  = defaultdict(int)
+            self.latencies = defaultdict(list)
+
+    @contextlib.contextmanager
+    def phase(self, name):
+        """Context manager recording the wall time spent in phase `name`"""
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            elapsed = time.perf_counter() - start
+            with self.lock:
+                self.phases[name] = self.phases.get(name, 0) + elapsed
+
+    def count(self, name, value = 1):
+        with self.lock:
+            self.counters[name] += value
+
+    def latency(self, name, seconds):
+        with self.lock:
+            self.latencies[name].append(seconds)
+
+    def report(self):
+        """Returns the collected statistics as a dict"""
+        with self.lock:
+            latencies = {}
+            for name, values in self.latencies.items():
+                values = sorted(values)
+                latencies[name] = {
+                        'count' : len(values),
+                        'total' : sum(values),
+                        'p50'   : percentile(values, 50),
+                        'p90'   : percentile(values, 90),
+                        'p99'   : percentile(values, 99),
+                        'max'   : values[-1],
+                        }
+            return {
+                    'phases'    : dict(self.phases),
+                    'counters'  : dict(self.counters),
+                    'latencies' : latencies,
+                    }
+
+    def table(self):
+        """Returns the collected statistics as a human readable table"""
+        report = self.report()
+        lines  = [ 'Phase                       Wall time' ]
+        for name, seconds in report['phases'].items():
+            lines.append(f'  {name:<24} {seconds:9.3f}s')
+        lines.append('Counter                         Value')
+        for name, value in sorted(report['counters'].items()):
+            lines.append(f'  {name:<24} {value:10d}')
+        lines.append('Latency        Count     Total       p50       p90       p99       max')
+        for name, lat in report['latencies'].items():
+            lines.append(f"  {name:<10} {lat['count']:7d} {lat['total']:8.3f}s " + ' '.join(f'{lat[key]:8.3f}s' for key in [ 'p50', 'p90', 'p99', 'max' ]))
+        return '\n'.join(lines)
+
+    def write_json(self, path):
+        with open(path, 'w') as outfile:
+            json.dump(self.report(), outfile, indent = 2)
+
+# Statistics of the current run
+collector = RunStats()
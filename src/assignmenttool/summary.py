@@ -0,0 +1,151 @@
+# Copyright (c) 2020 Leon Kuchenbecker <leon.kuchenbecker@uni-tuebingen.de>
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+
+import os
+
+import numpy as np
+import pandas as pd
+
+from assignmenttool import grading
+from assignmenttool.errors import AToolError
+from assignmenttool.workbook import load_workbook
+
+class ScoreMatrix:
+    """The scores of all participants as a dense array with one row per
+    participant and one column per subtask. Rows follow the order of the
+    Participants tab, columns the order of the Sheets tab grouped by sheet.
+    Subtasks a participant was not graded on are NaN."""
+
+    def __init__(self, users, names, subtasks, max_scores, scores):
+        self.users      = users
+        self.names      = names
+        self.subtasks   = subtasks
+        self.max_scores = max_scores
+        self.scores     = scores
+
+        # Columns of each sheet form a contiguous block starting at sheet_starts
+        self.sheets, self.sheet_starts = np.unique(subtasks.get_level_values('Sheet').to_numpy(), return_index = True)
+
+    @classmethod
+    def from_workbook(cls, workbook):
+        """Validates the grades of all sheets and builds the score matrix"""
+        participants = workbook.participants.drop_duplicates('Username')
+        users        = pd.Index(participants.Username)
+        meta         = workbook.sheets.drop_duplicates(grading.TASK_KEYS, keep = 'last').sort_values('Sheet', kind = 'stable')
+        subtasks     = pd.MultiIndex.from_frame(meta[grading.TASK_KEYS])
+
+        tasks = grading.aggregate(workbook.grading, workbook.sheets).tasks
+        rows  = users.get_indexer(tasks.Username)
+        if (rows < 0).any():
+            raise AToolError(f'Cannot find real name for user "{tasks.Username[rows < 0].iloc[0]}".')
+        columns = subtasks.get_indexer(pd.MultiIndex.from_frame(tasks[grading.TASK_KEYS]))
+
+        scores = np.full((len(users), len(subtasks)), np.nan)
+        scores[rows, columns] = tasks.Score.to_numpy(dtype = float)
+        return cls(users, participants.Name.to_numpy(), subtasks, meta.MaxScore.to_numpy(dtype = float), scores)
+
+    def _per_sheet(self, values):
+        return np.add.reduceat(values, self.sheet_starts, axis = 1)
+
+    def sheet_totals(self):
+        """Returns the total score of every participant on every sheet as a
+        users × sheets array, NaN for sheets a participant was not graded on"""
+        graded = self._per_sheet((~np.isnan(self.scores)).astype(int)) > 0
+        totals = self._per_sheet(np.nan_to_num(self.scores))
+        return np.where(graded, totals, np.nan)
+
+    def sheet_max_scores(self):
+        """Returns the maximum attainable score of every sheet"""
+        return np.add.reduceat(self.max_scores, self.sheet_starts)
+
+def _describe(frame):
+    """Computes the statistics of every column of `frame`, ignoring NaN"""
+    return pd.DataFrame({
+        'Graded' : frame.count(),
+        'Mean'   : frame.mean(),
+        'Median' : frame.median(),
+        'Std'    : frame.std(),
+        'Min'    : frame.min(),
+        'Max'    : frame.max(),
+        })
+
+def summarize_matrix(matrix, pass_threshold = None):
+    """Computes the per-sheet statistics, the per-task statistics and the
+    totals of all participants. Only sheets with at least one graded
+    participant count towards the maximum total score."""
+    sheet_totals = matrix.sheet_totals()
+    sheet_max    = matrix.sheet_max_scores()
+
+    sheets = _describe(pd.DataFrame(sheet_totals, columns = matrix.sheets))
+    sheets.insert(0, 'MaxScore', sheet_max)
+    sheets = sheets.rename_axis('Sheet').reset_index()
+
+    tasks = _describe(pd.DataFrame(matrix.scores, columns = matrix.subtasks))
+    tasks.insert(0, 'MaxScore', matrix.max_scores)
+    tasks = tasks.reset_index()
+
+    graded_sheets = sheets.Graded.to_numpy() > 0
+    totals = pd.DataFrame(sheet_totals[:, graded_sheets], columns = [ f'Sheet {sheet}' for sheet in matrix.sheets[graded_sheets] ])
+    totals.insert(0, 'Username', matrix.users)
+    totals.insert(1, 'Name', matrix.names)
+    totals['Total']    = np.nansum(sheet_totals, axis = 1)
+    totals['MaxTotal'] = sheet_max[graded_sheets].sum()
+    totals['Percent']  = 100 * totals.Total / totals.MaxTotal if totals.MaxTotal.any() else np.nan
+    if pass_threshold is not None:
+        totals['Passed'] = totals.Percent >= pass_threshold
+
+    return sheets, tasks, totals
+
+def _format(frame):
+    return frame.to_string(index = False, float_format = lambda value : f'{value:.2f}', na_rep = '-')
+
+def summarize(config):
+    """Prints or exports the statistics of the Excel file"""
+    workbook = load_workbook(config.infile, None if config.no_cache else os.path.join(config.cache_dir, 'workbook'))
+    matrix   = ScoreMatrix.from_workbook(workbook)
+    sheets, tasks, totals = summarize_matrix(matrix, config.pass_threshold)
+
+    if config.output:
+        try:
+            if config.output.lower().endswith('.xlsx'):
+                with pd.ExcelWriter(config.output) as writer:
+                    sheets.to_excel(writer, sheet_name = 'Sheets', index = False)
+                    tasks.to_excel(writer, sheet_name = 'Tasks', index = False)
+                    totals.to_excel(writer, sheet_name = 'Totals', index = False)
+            else:
+                os.makedirs(config.output, exist_ok = True)
+                sheets.to_csv(os.path.join(config.output, 'sheets.csv'), index = False)
+                tasks.to_csv(os.path.join(config.output, 'tasks.csv'), index = False)
+                totals.to_csv(os.path.join(config.output, 'totals.csv'), index = False)
+        except OSError as e:
+            raise AToolError(f"Cannot write summary to '{config.output}': {e}")
+        print(f"[OK]\tSummary of {len(matrix.users)} participants written to '{config.output}'")
+        return 0
+
+    print(_format(sheets))
+    print()
+    print(f'{len(matrix.users)} participants, mean total {totals.Total.mean():.2f} of {totals.MaxTotal.iloc[0] if len(totals) else 0:.2f}')
+    if config.pass_threshold is not None:
+        failing = totals[~totals.Passed]
+        print(f'{len(failing)} participants below {config.pass_threshold:g}%')
+        if not failing.empty:
+            print(_format(failing[[ 'Username', 'Name', 'Total', 'Percent' ]]))
+    return 0
@@ -0,0 +1,74 @@
+# Copyright (c) 2020 Leon Kuchenbecker <leon.kuchenbecker@uni-tuebingen.de>
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+
+import re
+
+# Placeholders have the form §§name§§
+_PLACEHOLDER_PATTERN = re.compile(r'§§(\w+)§§')
+
+# Replacements for characters with a special meaning in LaTeX
+_LATEX_SPECIALS = {
+        '\\' : r'\textbackslash{}',
+        '&'  : r'\&',
+        '%'  : r'\%',
+        '$'  : r'\$',
+        '#'  : r'\#',
+        '_'  : r'\_',
+        '{'  : r'\{',
+        '}'  : r'\}',
+        '~'  : r'\textasciitilde{}',
+        '^'  : r'\textasciicircum{}',
+        }
+_LATEX_SPECIALS_PATTERN = re.compile('|'.join(re.escape(char) for char in _LATEX_SPECIALS))
+
+def escape_latex(text):
+    """Escapes all characters in `text` that have a special meaning in LaTeX"""
+    return _LATEX_SPECIALS_PATTERN.sub(lambda match : _LATEX_SPECIALS[match.group(0)], text)
+
+class Template:
+    """A text containing §§name§§ placeholders. The text is split into
+    literal and placeholder segments once, so that rendering only requires a
+    single pass. If `known` is given, a warning is printed for every
+    placeholder not contained in it."""
+
+    def __init__(self, text, known = None, description = 'template'):
+        self.segments     = []
+        self.placeholders = set()
+        pos = 0
+        for match in _PLACEHOLDER_PATTERN.finditer(text):
+            self.segments.append((text[pos:match.start()], match.group(1)))
+            self.placeholders.add(match.group(1))
+            pos = match.end()
+        self.segments.append((text[pos:], None))
+
+        if known is not None:
+            for name in sorted(self.placeholders - set(known)):
+                print(f'[WARN]\tUnknown variable §§{name}§§ in {description}.')
+
+    def render(self, values):
+        """Substitutes the placeholders with the values from the dict
+        `values`. Placeholders without a value are left unchanged."""
+        out = []
+        for literal, name in self.segments:
+            out.append(literal)
+            if name is not None:
+                out.append(str(values[name]) if name in values else f'§§{name}§§')
+        return ''.join(out)
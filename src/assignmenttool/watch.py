@@ -0,0 +1,218 @@
+# Copyright (c) 2020 Leon Kuchenbecker <leon.kuchenbecker@uni-tuebingen.de>
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+
+import os
+import shutil
+import tempfile
+import time
+
+from concurrent.futures import ThreadPoolExecutor
+
+import pandas as pd
+
+from assignmenttool import grading, read_templates, render_documents, select_sheets
+from assignmenttool.errors import AToolError, CompileError
+from assignmenttool.latex import compileLaTeX, compile_cohort, build_format, CompileGroup, CompileStats
+from assignmenttool.pdfcache import PDFCache
+from assignmenttool.stats import collector
+from assignmenttool.workbook import load_workbook
+
+# Seconds between two checks for modified input files
+POLL_INTERVAL = 1.0
+
+def _stamp(path):
+    """Returns the modification time and size of `path` or None if it cannot
+    be accessed"""
+    try:
+        stat = os.stat(path)
+    except OSError:
+        return None
+    return stat.st_mtime_ns, stat.st_size
+
+def _signatures(frame):
+    """Returns a dict mapping every user to a signature of their rows in
+    `frame`, which changes if any of the rows or their order changes"""
+    if frame.empty:
+        return {}
+    hashes = pd.util.hash_pandas_object(frame, index = False)
+    return hashes.groupby(frame.Username.values, sort = False).agg(tuple).to_dict()
+
+def _write_pdf(path, pdf):
+    """Replaces the PDF at `path` without leaving a partially written file
+    behind"""
+    tmppath = path + '.tmp'
+    with open(tmppath, 'wb') as outfile:
+        outfile.write(pdf)
+    os.replace(tmppath, path)
+
+class Watcher:
+    """Keeps the grades and rendered documents of the previous regeneration
+    in memory, so that only the documents of participants whose grades
+    changed are compiled again"""
+
+    def __init__(self, config):
+        self.config     = config
+        self.cache      = None if config.no_cache else PDFCache(os.path.join(config.cache_dir, 'pdf'), config.cache_size, config.pdflatex_path, config.pdflatex_version)
+        self.executor   = ThreadPoolExecutor(max_workers = config.jobs)
+        self.group      = CompileGroup()
+        self.fmt_tmpdir = None
+        self.fmt        = None
+        self.template   = None
+        self.sheet_meta = None
+        self.signatures = {}
+        self.documents  = {}
+
+    def close(self):
+        self.group.cancel()
+        self.executor.shutdown(wait = True, cancel_futures = True)
+        if self.fmt_tmpdir:
+            shutil.rmtree(self.fmt_tmpdir, ignore_errors = True)
+
+    def _build_format(self, template):
+        if self.config.no_format:
+            return None
+        if self.cache:
+            fmt_dir = os.path.join(self.config.cache_dir, 'fmt')
+        else:
+            if not self.fmt_tmpdir:
+                self.fmt_tmpdir = tempfile.mkdtemp(dir = self.config.build_dir)
+            fmt_dir = self.fmt_tmpdir
+        with collector.phase('format'):
+            fmt = build_format(template, self.config.pdflatex, self.config.pdflatex_version, fmt_dir, self.config.compile_timeout, self.config.build_dir, self.group)
+        if fmt is None:
+            print('[WARN]\tFailed to precompile the template preamble, compiling full documents instead.')
+        return fmt
+
+    def regenerate(self):
+        """Reads the Excel file and the LaTeX template and regenerates the
+        PDFs of all participants whose grades changed since the last call"""
+        config = self.config
+        with collector.phase('read'):
+            workbook = load_workbook(config.infile, None if config.no_cache else os.path.join(config.cache_dir, 'workbook'))
+        template, tex_template, filename_template = read_templates(config)
+        participants     = workbook.participants.set_index('Username')
+        sheet_meta       = workbook.sheets
+        max_scores_sheet = sheet_meta.groupby('Sheet')['MaxScore'].sum()
+        sheets           = select_sheets(config, workbook.grading)
+        scores           = workbook.grading[workbook.grading.Sheet.isin(sheets)]
+
+        # A modified template or modified maximum scores affect all documents
+        if template != self.template or self.sheet_meta is None or not sheet_meta.equals(self.sheet_meta):
+            previous, known = {}, {}
+            fmt = self._build_format(template)
+        else:
+            previous, known = self.documents, self.signatures
+            fmt = self.fmt
+
+        # Participants are rendered again if their grades or names changed
+        names      = _signatures(workbook.participants)
+        signatures = { user : (rows, names.get(user)) for user, rows in _signatures(scores).items() }
+        changed    = { user for user, signature in signatures.items() if known.get(user) != signature }
+
+        documents = []
+        changed_scores = scores[scores.Username.isin(changed)]
+        for sheet in sheets:
+            sheet_scores = changed_scores[changed_scores.Sheet == sheet]
+            if sheet_scores.empty:
+                continue
+            with collector.phase('aggregate'):
+                grades = grading.aggregate(sheet_scores, sheet_meta)
+            with collector.phase('render'):
+                documents += render_documents(config, tex_template, filename_template, sheet, grades, participants, max_scores_sheet)
+
+        # Only compile documents that actually differ from the previous ones
+        current = { key : document for key, document in previous.items() if key[1] in signatures and key[1] not in changed }
+        todo    = []
+        for document in documents:
+            if previous.get((document.sheet, document.user)) == document:
+                current[(document.sheet, document.user)] = document
+            else:
+                todo.append(document)
+
+        label = lambda document : document.user if len(sheets) == 1 else f'{document.user} [sheet {document.sheet}]'
+        stats = CompileStats()
+        def build(document):
+            try:
+                return compileLaTeX(document.tex, config.pdflatex, config.debug, self.cache, stats, fmt, config.compile_timeout, config.compile_retries, config.build_dir, self.group)[1]
+            except AToolError as e:
+                return e
+
+        with collector.phase('pipeline'):
+            results = None
+            if config.cohort and todo:
+                try:
+                    results = [ pdf for _, pdf in compile_cohort([ document.tex for document in todo ], config.pdflatex, config.debug, self.cache, stats, fmt, config.compile_timeout, config.compile_retries, config.build_dir, self.group) ]
+                except CompileError as e:
+                    print(f'[WARN]\tCompiling all documents at once failed, compiling them one by one: {e}')
+            if results is None:
+                results = self.executor.map(build, todo)
+            for document, pdf in zip(todo, results):
+                if isinstance(pdf, AToolError):
+                    print(f'[FAILED]\t{label(document)}: {pdf}')
+                    for line in getattr(pdf, 'log', '').splitlines():
+                        print(f'    {line}')
+                    continue
+                try:
+                    _write_pdf(document.outpath, pdf)
+                except OSError as e:
+                    print(f"[FAILED]\t{label(document)}: Cannot write '{document.outpath}': {e}")
+                    continue
+                collector.count('bytes_written', len(pdf))
+                current[(document.sheet, document.user)] = document
+                print(f'[OK]\t{label(document)}')
+
+        # Participants whose documents could not be generated are considered
+        # changed and retried on the next regeneration
+        failed = { document.user for document in todo if (document.sheet, document.user) not in current }
+        self.template, self.sheet_meta, self.fmt = template, sheet_meta, fmt
+        self.signatures = { user : signature for user, signature in signatures.items() if user not in failed }
+        self.documents  = current
+
+        if todo:
+            print(f'Compiled {stats}')
+        else:
+            print('No changes')
+
+def watch(config):
+    """Regenerates the PDFs whenever the Excel file or the LaTeX template is
+    modified until interrupted"""
+    collector.reset()
+    watcher = Watcher(config)
+    print(f"Watching '{config.infile}' and '{config.tex_template}' for changes, press Ctrl-C to stop.")
+    handled  = None
+    previous = None
+    try:
+        while True:
+            stamps = (_stamp(config.infile), _stamp(config.tex_template))
+            # Wait until the files stopped changing, e.g. while being saved
+            if stamps != handled and (handled is None or stamps == previous):
+                handled = stamps
+                try:
+                    watcher.regenerate()
+                except AToolError as e:
+                    print(f'[FAILED]\t{e}')
+            previous = stamps
+            time.sleep(POLL_INTERVAL)
+    except KeyboardInterrupt:
+        print('\nStopped watching.')
+    finally:
+        watcher.close()
+    return 0
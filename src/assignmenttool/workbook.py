@@ -0,0 +1,175 @@
+# Copyright (c) 2020 Leon Kuchenbecker <leon.kuchenbecker@uni-tuebingen.de>
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+
+import hashlib
+import os
+import shutil
+import tempfile
+
+from collections import namedtuple
+
+import pandas as pd
+
+from assignmenttool.errors import AToolError
+
+Workbook = namedtuple('Workbook', [ 'grading', 'participants', 'sheets' ])
+
+# Columns and data types read from the individual spreadsheets. Columns with a
+# data type of None are read as inferred by pandas, columns marked as optional
+# are only read if present.
+SPREADSHEETS = {
+        'grading' : ('Grading', {
+            'Username' : str,
+            'Sheet'    : 'Int64',
+            'Task'     : 'Int64',
+            'Subtask'  : 'Int64',
+            'Type'     : str,
+            'Value'    : object,
+            }, []),
+        'participants' : ('Participants', {
+            'Username' : str,
+            'Name'     : str,
+            'E-Mail'   : str,
+            }, [ 'E-Mail' ]),
+        'sheets' : ('Sheets', {
+            'Sheet'    : 'Int64',
+            'Task'     : 'Int64',
+            'Subtask'  : 'Int64',
+            'MaxScore' : None,
+            }, []),
+        }
+
+# Encoding of the mixed type 'Value' column in the columnar cache
+_VALUE_NONE, _VALUE_INT, _VALUE_FLOAT, _VALUE_TEXT = range(4)
+
+def _read_excel(infile):
+    """Reads all required spreadsheets from the Excel file, opening and
+    parsing it only once"""
+    try:
+        xls = pd.ExcelFile(infile)
+    except Exception as e:
+        raise AToolError(f"Cannot open Excel file '{infile}': {e}")
+    with xls:
+        frames = {}
+        for key, (sheet_name, dtypes, optional) in SPREADSHEETS.items():
+            if sheet_name not in xls.sheet_names:
+                raise AToolError(f'Failed to parse provided Excel file, sheet "{sheet_name}" is missing.')
+            frame = xls.parse(sheet_name, usecols = lambda column : column in dtypes, dtype = { column : dtype for column, dtype in dtypes.items() if dtype is not None })
+            missing = [ column for column in dtypes if column not in frame.columns and column not in optional ]
+            if missing:
+                raise AToolError(f'Failed to parse provided Excel file, "{sheet_name}" sheet lacks the column(s) {", ".join(missing)}.')
+            frames[key] = frame
+    return Workbook(**frames)
+
+def _encode_values(frame):
+    """Splits the mixed type 'Value' column into typed columns"""
+    kinds, numbers, texts = [], [], []
+    for value in frame['Value']:
+        if isinstance(value, str):
+            kinds.append(_VALUE_TEXT); numbers.append(None); texts.append(value)
+        elif pd.isna(value):
+            kinds.append(_VALUE_NONE); numbers.append(None); texts.append(None)
+        else:
+            kinds.append(_VALUE_FLOAT if isinstance(value, float) else _VALUE_INT)
+            numbers.append(float(value)); texts.append(None)
+    frame = frame.drop(columns = [ 'Value' ])
+    frame['ValueKind']   = pd.Series(kinds, index = frame.index, dtype = 'int8')
+    frame['ValueNumber'] = pd.Series(numbers, index = frame.index, dtype = 'float64')
+    frame['ValueText']   = pd.Series(texts, index = frame.index, dtype = object)
+    return frame
+
+def _decode_values(frame):
+    """Reverses _encode_values()"""
+    values = []
+    for kind, number, text in zip(frame['ValueKind'], frame['ValueNumber'], frame['ValueText']):
+        if kind == _VALUE_TEXT:
+            values.append(text)
+        elif kind == _VALUE_INT:
+            values.append(int(number))
+        elif kind == _VALUE_FLOAT:
+            values.append(number)
+        else:
+            values.append(None)
+    frame = frame.drop(columns = [ 'ValueKind', 'ValueNumber', 'ValueText' ])
+    frame['Value'] = pd.Series(values, index = frame.index, dtype = object)
+    return frame
+
+def _sidecar_paths(infile, cache_dir):
+    """Returns the cache directory for the current state of `infile` and the
+    prefix shared by all cache directories of that file"""
+    path   = os.path.abspath(infile)
+    stat   = os.stat(path)
+    prefix = hashlib.sha256(path.encode('utf-8')).hexdigest()[:16]
+    state  = hashlib.sha256(f'{stat.st_mtime_ns}\0{stat.st_size}'.encode('utf-8')).hexdigest()[:16]
+    return os.path.join(cache_dir, f'{prefix}-{state}'), prefix
+
+def _load_sidecar(directory):
+    try:
+        frames = { key : pd.read_parquet(os.path.join(directory, key + '.parquet')) for key in SPREADSHEETS }
+    except Exception:
+        return None
+    frames['grading'] = _decode_values(frames['grading'])
+    return Workbook(**frames)
+
+def _store_sidecar(workbook, directory, prefix):
+    cache_dir = os.path.dirname(directory)
+    tdir = None
+    try:
+        os.makedirs(cache_dir, exist_ok = True)
+        tdir = tempfile.mkdtemp(dir = cache_dir)
+        for key, frame in workbook._asdict().items():
+            if key == 'grading':
+                frame = _encode_values(frame)
+            frame.to_parquet(os.path.join(tdir, key + '.parquet'), index = False)
+        # Replace cached versions of outdated states of the same file
+        for entry in os.scandir(cache_dir):
+            if entry.name.startswith(prefix + '-'):
+                shutil.rmtree(entry.path, ignore_errors = True)
+        os.replace(tdir, directory)
+    except Exception:
+        # A failing cache must never fail the run
+        if tdir:
+            shutil.rmtree(tdir, ignore_errors = True)
+
+def load_workbook(infile, cache_dir = None):
+    """Reads the 'Grading', 'Participants' and 'Sheets' spreadsheets from the
+    Excel file `infile`. If `cache_dir` is given and pyarrow is available,
+    the parsed spreadsheets are cached in Parquet format and reused for as
+    long as the modification time and size of `infile` do not change."""
+    if cache_dir:
+        try:
+            import pyarrow
+        except ImportError:
+            cache_dir = None
+    if cache_dir:
+        try:
+            directory, prefix = _sidecar_paths(infile, cache_dir)
+        except OSError as e:
+            raise AToolError(f"Cannot open Excel file '{infile}': {e}")
+        workbook = _load_sidecar(directory)
+        if workbook is not None:
+            return workbook
+
+    workbook = _read_excel(infile)
+
+    if cache_dir:
+        _store_sidecar(workbook, directory, prefix)
+    return workbook